@@ -0,0 +1,80 @@
+# Animated images (GIF, MNG): the parsed animation is cached by the viewer, and AnimationPlayer shows it fit to the
+# window, scaling each frame only when it is due - resizing or revisiting never parses the file again.
+# GTK is imported lazily, like in tiles.py.
+
+import os
+import time
+
+ANIMATED_EXTENSIONS = ('.gif', '.mng')
+
+# never schedule frames closer than this, whatever the file says
+MIN_FRAME_DELAY_MS = 20
+
+
+def may_be_animated(filename):
+    return os.path.splitext(filename)[1].lower() in ANIMATED_EXTENSIONS
+
+
+def animation_size(animation, filename):
+    """
+    Rough memory footprint of a parsed animation in bytes - the loaders do not expose it. The frames are kept
+    decoded, so it is at least one full frame, and typically a few times the size of the compressed file.
+    """
+    return max(animation.get_width() * animation.get_height() * 4, os.path.getsize(filename) * 4)
+
+
+class AnimationPlayer(object):
+    """
+    Plays a GdkPixbuf.PixbufAnimation in a Gtk.Image at the given size. Frames are timed by the wall clock: when
+    scaling a frame takes longer than the animation allows, the iterator skips to the frame due now instead of the
+    animation slowing down.
+    """
+
+    def __init__(self, filename, image, animation, size):
+        self.filename = filename
+        self.image = image
+        self.animation = animation
+        self.size = size
+        self.iter = None
+        self.frame = None
+        self.timer = None
+
+    def start(self):
+        """Shows the first frame right away and schedules the rest"""
+        self.iter = self.animation.get_iter(None)
+        self.show_frame()
+        self.schedule(0)
+
+    def stop(self):
+        from gi.repository import GObject
+        if self.timer:
+            GObject.source_remove(self.timer)
+            self.timer = None
+
+    def set_size(self, size):
+        if size != self.size:
+            self.size = size
+            self.show_frame()
+
+    def show_frame(self):
+        from gi.repository import GdkPixbuf
+        pixbuf = self.iter.get_pixbuf()
+        if (pixbuf.get_width(), pixbuf.get_height()) != self.size:
+            pixbuf = pixbuf.scale_simple(self.size[0], self.size[1], GdkPixbuf.InterpType.BILINEAR)
+        self.frame = pixbuf
+        self.image.set_from_pixbuf(pixbuf)
+
+    def schedule(self, spent_ms):
+        from gi.repository import GObject
+        delay = self.iter.get_delay_time()
+        if delay < 0:
+            self.timer = None   # the last frame stays
+            return
+        self.timer = GObject.timeout_add(max(MIN_FRAME_DELAY_MS, delay - spent_ms), self.tick)
+
+    def tick(self):
+        started = time.time()
+        if self.iter.advance(None):
+            self.show_frame()
+        self.schedule(int((time.time() - started) * 1000))
+        return False
@@ -0,0 +1,102 @@
+import threading
+from collections import OrderedDict
+
+
+def pixbuf_size(value):
+    """Approximate memory footprint of a cached pixbuf (or a (pixbuf, ...) tuple), in bytes"""
+    pixbuf = value[0] if isinstance(value, tuple) else value
+    return pixbuf.get_rowstride() * pixbuf.get_height()
+
+
+class LruCache(object):
+    """
+    Thread-safe LRU cache bounded by a total size in bytes.
+    The size of each value is computed with the sizeof function given to the constructor.
+    Keys marked as protected (the current image and its prefetch window) are evicted only after all the
+    other entries are gone, and then the least important first - the order set_protected() got them in.
+    """
+
+    def __init__(self, max_bytes, sizeof=len):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.lock = threading.RLock()
+        self.entries = OrderedDict()    # key -> (value, size), least recently used first
+        self.protected = {}     # key -> priority, 0 being the most important
+        self.total_bytes = 0
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def __getitem__(self, key):
+        with self.lock:
+            value, size = self.entries.pop(key)
+            self.entries[key] = value, size
+            return value
+
+    def __setitem__(self, key, value):
+        size = self.sizeof(value)
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = value, size
+            self.total_bytes += size
+            self.evict(keep=key)
+
+    def __delitem__(self, key):
+        with self.lock:
+            self.total_bytes -= self.entries.pop(key)[1]
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self[key] if key in self.entries else default
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if not key in self.entries:
+                return default
+            value, size = self.entries.pop(key)
+            self.total_bytes -= size
+            return value
+
+    def keys(self):
+        with self.lock:
+            return list(self.entries.keys())
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def set_protected(self, keys):
+        with self.lock:
+            self.protected = {}
+            for priority, key in enumerate(keys):
+                self.protected.setdefault(key, priority)
+            self.evict()
+
+    def resize(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.evict()
+
+    def evict(self, keep=None):
+        """
+        Drops least recently used entries until we are within budget, then protected ones, the least important first.
+        The keep entry is only dropped for a more important protected one - never when it is alone.
+        """
+        with self.lock:
+            for key in list(self.entries.keys()):
+                if self.total_bytes <= self.max_bytes:
+                    return
+                if key != keep and key not in self.protected:
+                    self.total_bytes -= self.entries.pop(key)[1]
+            for key in sorted(self.protected, key=self.protected.get, reverse=True):
+                if self.total_bytes <= self.max_bytes:
+                    return
+                if key in self.entries and (key != keep or len(self.entries) > 1):
+                    self.total_bytes -= self.entries.pop(key)[1]
@@ -0,0 +1,82 @@
+import heapq
+import threading
+
+
+class DecodeCancelled(Exception):
+    """Raised from a decode that was aborted because its image is no longer needed"""
+    pass
+
+
+class DecodeQueue(object):
+    """
+    Prioritized decode requests for the cache thread. Every navigation submits the whole prefetch window again,
+    most important first, under a new generation: requests that fell out of the window are dropped before they
+    start, and is_wanted() tells decodes already running for them to stop.
+    Also keeps track of the decodes running in any thread, so that the same image is never decoded twice at once.
+    """
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.heap = []      # (priority, seq, key)
+        self.seq = 0
+        self.generation = 0
+        self.wanted = set()
+        self.running = {}   # key -> Event set when the decode ends
+
+    def submit(self, keys):
+        """Replaces all pending requests with keys, in order of priority. Returns the new generation."""
+        with self.lock:
+            self.generation += 1
+            self.heap = []
+            self.wanted = set()
+            for priority, key in enumerate(keys):
+                if key not in self.wanted:
+                    self.wanted.add(key)
+                    self.seq += 1
+                    heapq.heappush(self.heap, (priority, self.seq, key))
+            self.lock.notify_all()
+            return self.generation
+
+    def get(self, timeout=None):
+        """Blocks until there is a request, returns (key, generation) of the most important one"""
+        with self.lock:
+            while not self.heap:
+                self.lock.wait(timeout)
+                if timeout is not None and not self.heap:
+                    return None, None
+            priority, seq, key = heapq.heappop(self.heap)
+            return key, self.generation
+
+    def pending(self):
+        with self.lock:
+            return [key for priority, seq, key in sorted(self.heap)]
+
+    def is_wanted(self, key, generation):
+        """False once a request of the given generation fell out of the prefetch window"""
+        with self.lock:
+            return generation == self.generation or key in self.wanted
+
+    def start(self, key):
+        """Marks key as being decoded. Returns False if another thread is already decoding it."""
+        with self.lock:
+            if key in self.running:
+                return False
+            self.running[key] = threading.Event()
+            return True
+
+    def finish(self, key):
+        with self.lock:
+            event = self.running.pop(key, None)
+        if event:
+            event.set()
+
+    def is_running(self, key):
+        with self.lock:
+            return key in self.running
+
+    def wait_for(self, key):
+        """Waits for a running decode of key (if any) to end, so that its result can be picked from the cache"""
+        with self.lock:
+            event = self.running.get(key)
+        if event:
+            event.wait()
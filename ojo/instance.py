@@ -0,0 +1,173 @@
+# Single-instance mode: the first Ojo listens on a unix socket, and later launches hand their path over to it and
+# exit - before importing GTK, so that opening images from the file manager costs next to nothing.
+# Only the standard library is used here, bin/ojo runs it first thing.
+
+import os
+import socket
+import stat
+import struct
+import sys
+import tempfile
+import threading
+
+# a running instance that does not answer within this long is considered hung, and a new one gets started
+HANDOVER_TIMEOUT = 2.0
+
+# not exported by the socket module of Python 2, the value is Linux's
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+
+
+def socket_path():
+    """
+    The socket, in a folder only our user can write to - $XDG_RUNTIME_DIR, or our own folder in the temp dir.
+    None if there is no such folder, e.g. when another user created ours first.
+    """
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    folder = runtime or os.path.join(tempfile.gettempdir(), 'ojo-%d' % os.getuid())
+    if not runtime:
+        try:
+            os.mkdir(folder, 0700)
+        except OSError:
+            pass    # exists already - checked below
+    if not is_private_dir(folder):
+        return None
+    return os.path.join(folder, 'ojo-%d.sock' % os.getuid())
+
+
+def is_private_dir(folder):
+    try:
+        st = os.lstat(folder)
+    except OSError:
+        return False
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and not st.st_mode & 0077
+
+
+def is_own_socket(path):
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid()
+
+
+def peer_uid(sock):
+    """The user at the other end of a connected unix socket, or None where the OS does not tell"""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        pid, uid, gid = struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize('3i')))
+        return uid
+    except (socket.error, struct.error):
+        return None
+
+
+def is_trusted_peer(sock):
+    uid = peer_uid(sock)
+    return uid is None or uid == os.getuid()
+
+
+def hand_over(args, path=None):
+    """
+    Gives the file or folder named in the command line args to a running Ojo. Returns True if it took it over,
+    False if this process should start normally. Launches with options or several arguments are never handed over.
+    """
+    if len(args) > 1 or any(a.startswith('-') for a in args):
+        return False
+    target = os.path.realpath(args[0]) if args else ''
+    if args and not os.path.exists(target):
+        return False
+    path = path or socket_path()
+    if not path or not is_own_socket(path):
+        return False
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(HANDOVER_TIMEOUT)
+    try:
+        sock.connect(path)
+        if not is_trusted_peer(sock):
+            return False
+        sock.sendall(target + '\0')
+        return sock.recv(16) == 'ok'
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+class Server(object):
+    """
+    Listens for handed over paths and calls on_open(path) with each of them, from its own thread - path is None if
+    the launch had no arguments.
+    """
+
+    def __init__(self, on_open, path=None):
+        self.on_open = on_open
+        self.path = path or socket_path()
+        self.sock = None
+
+    def start(self):
+        """
+        Starts listening. Returns False if another instance is already listening, raises IOError if the socket
+        cannot be put in a safe place.
+        """
+        if not self.path:
+            raise IOError('No private folder for the single instance socket')
+        if os.path.lexists(self.path):
+            if not is_own_socket(self.path):
+                raise IOError('%s is not a socket of ours, leaving it alone' % self.path)
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                return False
+            except socket.error:
+                os.unlink(self.path)    # left behind by an instance that crashed
+            finally:
+                probe.close()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0077)  # only our user may hand us paths
+        try:
+            self.sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        self.sock.listen(5)
+        thread = threading.Thread(target=self.serve, args=(self.sock,))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def serve(self, sock):
+        while self.sock is sock:
+            try:
+                conn, address = sock.accept()
+            except socket.error:
+                return  # closed
+            try:
+                if not is_trusted_peer(conn):
+                    continue
+                conn.settimeout(HANDOVER_TIMEOUT)
+                data = ''
+                while not data.endswith('\0'):
+                    chunk = conn.recv(4096)
+                    if not chunk:
+                        break
+                    data += chunk
+                if data.endswith('\0'):
+                    self.on_open(data[:-1] or None)
+                    conn.sendall('ok')
+            except socket.error:
+                pass
+            finally:
+                conn.close()
+
+    def close(self):
+        sock = self.sock
+        if sock:
+            self.sock = None
+            try:
+                sock.shutdown(socket.SHUT_RDWR)     # wakes up accept()
+            except socket.error:
+                pass
+            sock.close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
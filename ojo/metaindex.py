@@ -0,0 +1,81 @@
+import os
+import sqlite3
+import threading
+
+
+class MetaIndex(object):
+    """
+    Persistent index of the metadata we keep in Ojo.meta_cache, so that we do not need to parse the EXIF of
+    every image again each session. Entries are keyed by path and are only valid for the same size and mtime.
+    Writes are batched and committed together.
+    """
+
+    def __init__(self, db_path, batch_size=100):
+        self.batch_size = batch_size
+        self.lock = threading.RLock()
+        self.pending = {}
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.text_factory = str     # paths are byte strings
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta ("
+                        "path TEXT PRIMARY KEY, folder TEXT, size INTEGER, mtime REAL, "
+                        "needs_orientation INTEGER, needs_rotation INTEGER, width INTEGER, height INTEGER, "
+                        "orientation INTEGER)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS meta_folder ON meta (folder)")
+        self.db.commit()
+
+    @staticmethod
+    def to_info(row):
+        return bool(row[0]), bool(row[1]), row[2], row[3], row[4]
+
+    def get(self, path, size, mtime):
+        """Returns the meta_cache tuple for path, or None if we do not have a valid entry"""
+        with self.lock:
+            if path in self.pending:
+                row = self.pending[path]
+            else:
+                row = self.db.execute(
+                    "SELECT folder, size, mtime, needs_orientation, needs_rotation, width, height, orientation "
+                    "FROM meta WHERE path = ?", (path,)).fetchone()
+        if not row or row[1] != size or row[2] != mtime:
+            return None
+        return self.to_info(row[3:])
+
+    def load_folder(self, folder):
+        """Returns {path: (size, mtime, meta_cache tuple)} for all indexed images in folder, with a single query"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT path, size, mtime, needs_orientation, needs_rotation, width, height, orientation "
+                "FROM meta WHERE folder = ?", (folder,)).fetchall()
+            result = dict((row[0], (row[1], row[2], self.to_info(row[3:]))) for row in rows)
+            for path, row in self.pending.items():
+                if row[0] == folder:
+                    result[path] = row[1], row[2], self.to_info(row[3:])
+        return result
+
+    def put(self, path, size, mtime, info):
+        with self.lock:
+            self.pending[path] = (os.path.dirname(path), size, mtime) + tuple(info)
+            if len(self.pending) >= self.batch_size:
+                self.flush()
+
+    def remove(self, path):
+        with self.lock:
+            self.pending.pop(path, None)
+            self.db.execute("DELETE FROM meta WHERE path = ?", (path,))
+            self.db.commit()
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            self.db.executemany(
+                "INSERT OR REPLACE INTO meta (path, folder, size, mtime, needs_orientation, needs_rotation, "
+                "width, height, orientation) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(path,) + row for path, row in self.pending.items()])
+            self.db.commit()
+            self.pending = {}
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.db.close()
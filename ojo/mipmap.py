@@ -0,0 +1,75 @@
+# Continuous zoom: renditions of an image at 1/2, 1/4, ... of its size, built once from the decoded pixbuf and
+# then drawn scaled with cairo - changing the zoom never decodes the image again.
+# GTK is imported lazily, like in tiles.py.
+
+import tiles
+
+# levels stop once they fit in this - there is no point in halving further
+MIN_LEVEL_SIZE = 64
+
+
+class MipChain(object):
+    """
+    The levels of an image of size, starting from pixbuf - the full image, or for images too big to decode whole, a
+    smaller rendition of it. Scales are relative to size either way.
+    """
+
+    def __init__(self, pixbuf, size=None):
+        from gi.repository import GdkPixbuf
+        self.size = size or (pixbuf.get_width(), pixbuf.get_height())
+        self.levels = [pixbuf]
+        sizes = tiles.level_sizes((pixbuf.get_width(), pixbuf.get_height()), MIN_LEVEL_SIZE)
+        for w, h in sizes[1:]:
+            self.levels.append(self.levels[-1].scale_simple(w, h, GdkPixbuf.InterpType.BILINEAR))
+
+    def get_width(self):
+        return self.size[0]
+
+    def get_height(self):
+        return self.size[1]
+
+    def get_level(self, scale):
+        scale *= float(self.get_width()) / self.levels[0].get_width()    # relative to the first level
+        return self.levels[tiles.level_for_scale(scale, len(self.levels))]
+
+    def get_size(self):
+        """Memory footprint in bytes"""
+        return sum(p.get_rowstride() * p.get_height() for p in self.levels)
+
+
+class MipView(object):
+    """Draws a MipChain in a Gtk.DrawingArea at any scale, from the smallest level that is sharp enough"""
+
+    def __init__(self, filename, chain):
+        from gi.repository import Gtk
+        self.filename = filename
+        self.chain = chain
+        self.scale = 1.0
+        self.area = Gtk.DrawingArea()
+        self.area.set_halign(Gtk.Align.CENTER)
+        self.area.set_valign(Gtk.Align.CENTER)
+        self.area.connect('draw', self.on_draw)
+        self.area.set_visible(True)
+        self.update_size()
+
+    def get_display_size(self):
+        return max(1, int(self.chain.get_width() * self.scale)), max(1, int(self.chain.get_height() * self.scale))
+
+    def update_size(self):
+        self.area.set_size_request(*self.get_display_size())
+
+    def set_scale(self, scale):
+        if scale != self.scale:
+            self.scale = scale
+            self.update_size()
+            self.area.queue_draw()
+
+    def on_draw(self, area, cr):
+        from gi.repository import Gdk
+        pixbuf = self.chain.get_level(self.scale)
+        display_w, display_h = self.get_display_size()
+        # only the clipped (exposed) region actually gets scaled
+        cr.scale(float(display_w) / pixbuf.get_width(), float(display_h) / pixbuf.get_height())
+        Gdk.cairo_set_source_pixbuf(cr, pixbuf, 0, 0)
+        cr.paint()
+        return True
@@ -18,21 +18,65 @@
 
 # We import here only the things necessary to start and show an image.
 # The rest are imported lazily so they do not slow startup
+import startuptrace
 from gi.repository import Gtk, Gdk, GdkPixbuf, GObject
 import os
 import sys
 import time
+import threading
 import util
 import logging
 import ojoconfig
 import optparse
+from cache import LruCache, pixbuf_size
+from prefetch import NavigationTracker
+from decodequeue import DecodeQueue, DecodeCancelled
+import thumbnails
+import scanner
+import animation
+import xdgthumbs
+from thumbcache import ThumbnailCache
 
 import gettext
 from gettext import gettext as _
 gettext.textdomain('ojo')
 
+startuptrace.mark('imports')
+
 LEVELS = (logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG)
 
+# Commands for the browser are queued and sent as one batch per frame
+JS_BATCH_INTERVAL_MS = 16
+
+# Part of the pixbuf cache budget given to 100% zoomed renditions, the rest goes to fit-to-window ones
+ZOOM_CACHE_SHARE = 0.75
+
+# Continuous zoom: factor per wheel notch or key press, and the maximal magnification
+ZOOM_STEP = 1.25
+MAX_ZOOM_SCALE = 8.0
+
+# Prefetch decodes feed files to the loader in chunks of this size, checking between chunks whether to stop
+DECODE_CHUNK_SIZE = 64 * 1024
+
+# While the window is being resized the image is rescaled roughly from the master rendition; the final rescale
+# happens once no resize came for this long
+RESIZE_SETTLE_MS = 200
+
+# Files smaller than this (RAW files aside) decode fast enough to be shown directly, without a quick rendition first
+PROGRESSIVE_MIN_FILE_SIZE = 2 * 1024 * 1024
+
+# Option changes are saved together, a moment after they happen
+OPTIONS_SAVE_DELAY_MS = 1000
+
+# How often the thumbnail cache is garbage collected, and how long after startup
+THUMB_GC_INTERVAL = 24 * 3600
+THUMB_GC_DELAY = 30
+
+
+def prethumb_job(args):
+    # Pool.imap_unordered passes a single argument
+    return thumbnails.thumbnail_job(*args)
+
 
 killed = False
 def kill(*args):
@@ -48,8 +92,26 @@ class Ojo():
                           help=_('Print the maximum debugging info (implies -vv)'))
         parser.add_option('-v', '--verbose', dest='logging_level', action='count',
                           help=_('set error_level output to warning, info, and then debug'))
+        parser.add_option('--startup-trace', dest='startup_trace', action='store_true',
+                          help=_('Print how long each startup phase takes'))
+        parser.add_option('--cache-stats', dest='cache_stats', action='store_true',
+                          help=_('Print thumbnail cache statistics and exit'))
+        parser.add_option('--cache-prune', dest='cache_prune', action='store_true',
+                          help=_('Remove orphaned, expired and least recently used thumbnails, then exit'))
+        parser.add_option('--prethumb', dest='prethumb', metavar='DIR',
+                          help=_('Prepare the thumbnails of the images in DIR without opening a window, then exit'))
+        parser.add_option('-r', '--recursive', dest='recursive', action='store_true',
+                          help=_('With --prethumb, also prepare the thumbnails in all subfolders of DIR'))
+        parser.add_option('-j', '--jobs', dest='jobs', type='int', metavar='N',
+                          help=_('With --prethumb, the number of parallel workers (default: one per CPU core)'))
         parser.set_defaults(logging_level=0)
         (self.command_options, self.command_args) = parser.parse_args()
+        if (self.command_options.recursive or self.command_options.jobs) and not self.command_options.prethumb:
+            parser.error(_('-r and -j can only be used with --prethumb'))
+        if self.command_options.jobs is not None and self.command_options.jobs < 1:
+            parser.error(_('-j needs at least one job'))
+        if self.command_options.startup_trace:
+            startuptrace.enable()
 
     def setup_logging(self):
         # set the verbosity
@@ -62,11 +124,23 @@ class Ojo():
         self.parse_command_line()
         self.setup_logging()
         self.load_options()
+        self.init_caches()
+        startuptrace.mark('options')
+
+        if self.command_options.cache_stats or self.command_options.cache_prune:
+            self.run_cache_command()
+            return
+
+        if self.command_options.prethumb:
+            self.run_prethumb(self.command_options.prethumb)
+            return
 
         if len(self.command_args) >= 1 and os.path.exists(self.command_args[0]):
             path = os.path.realpath(self.command_args[0])
-        else:
+        elif self.options['folder']:
             path = self.options['folder'].encode('utf-8')
+        else:
+            path = util.get_xdg_pictures_folder()
         logging.info("Started with: %s" % path)
         if not os.path.exists(path):
             logging.warning("%s does not exist, reverting to %s" % (path, util.get_xdg_pictures_folder()))
@@ -106,10 +180,27 @@ class Ojo():
         if self.options['maximized']:
             self.window.maximize()
 
-        self.meta_cache = {}
-        self.pix_cache = {False: {}, True: {}} # keyed by "zoomed" property
-        self.current_preparing = None
+        startuptrace.mark('window')
+
+        self.js_queue = []
+        self.js_lock = threading.Lock()
+        self.js_flush_scheduled = False
+
+        # progressive display - see show_progressively()
+        self.display_generation = 0
+        self.display_request = None
+        self.display_lock = threading.Lock()
+        self.display_event = threading.Event()
+        self.display_thread = None
+
+        self.animation_player = None
+        self.resize_timer = None
+        self.interim_resize_pending = False
+        self.zoom_view = None   # used instead of self.image for big images and for zoom scales other than 100%
+        self.zoom_scroll_target = None  # where zoom_to() scrolls once the view got its new size
+        self.navigation = NavigationTracker()
         self.manually_resized = False
+        self.instance_server = None
 
         self.set_zoom(False, 0.5, 0.5)
         self.mode = 'image' if os.path.isfile(path) else 'folder'
@@ -120,6 +211,11 @@ class Ojo():
         if self.options['fullscreen']:
             self.window.resize(*self.get_recommended_size())
 
+        def _first_paint(*args):
+            startuptrace.mark('first paint')
+            self.window.disconnect(first_paint_handler)
+        first_paint_handler = self.window.connect_after('draw', _first_paint)
+
         if os.path.isfile(path):
             self.last_automatic_resize = time.time()
             self.show(path, quick=True)
@@ -142,15 +238,64 @@ class Ojo():
         Gtk.main()
         Gdk.threads_leave()
 
+    def init_caches(self):
+        """
+        The caches and decode queues, in memory and on disk, sized by the options - everything the imaging pipeline
+        needs, without a window. Also used by --prethumb and the benchmarks.
+        """
+        self.folder_model = None
+        self.thumb_cache = self.create_thumb_cache()
+        self.thumb_packs = self.create_thumb_packs()
+        self.thumb_store_lock = threading.Lock()    # packing a thumbnail vs. reading it before it gets packed
+        self.preview_cache = self.create_preview_cache()
+        self.meta_cache = {}
+        self.meta_index = None  # opened after the first image is shown
+        self.pix_cache = self.create_pix_cache() # keyed by "zoomed" property
+        self.mip_cache = LruCache(self.options['mip_cache_mb'] * 1024 * 1024, sizeof=lambda chain: chain.get_size())
+        self.anim_cache = LruCache(self.options['animation_cache_mb'] * 1024 * 1024, sizeof=lambda value: value[1])
+        self.resize_master = None   # (filename, the largest full-quality fit-to-window pixbuf of it shown so far)
+        self.building_pyramids = set()
+        self.building_pyramids_lock = threading.Lock()    # also changed by the build callbacks
+        self.retried_pyramids = set()
+        self.decode_queue = DecodeQueue()
+        # second tier: the undecoded bytes of the files around the current one, so decoding them needs no I/O
+        self.file_cache = LruCache(self.options['file_cache_mb'] * 1024 * 1024, sizeof=len)
+        self.read_queue = DecodeQueue()
+
     def js(self, command):
-        logging.debug('js(%s)' % command)
-        if hasattr(self, "web_view_loaded"):
-            GObject.idle_add(lambda: self.web_view.execute_script(command))
-        else:
-            GObject.timeout_add(100, lambda: self.js(command))
+        """Queues a raw piece of JavaScript, prefer js_call()"""
+        self.js_call('eval', command)
+
+    def js_call(self, function, *args):
+        """Queues a call to a function in browse.html, with JSON-serializable arguments"""
+        logging.debug('js: %s%s' % (function, args))
+        with self.js_lock:
+            self.js_queue.append([function, args])
+        self.schedule_js_flush()
+
+    def schedule_js_flush(self):
+        with self.js_lock:
+            if self.js_flush_scheduled or not hasattr(self, "web_view_loaded"):
+                return
+            self.js_flush_scheduled = True
+        GObject.timeout_add(JS_BATCH_INTERVAL_MS, self.flush_js)
+
+    def flush_js(self):
+        import json
+        with self.js_lock:
+            batch = self.js_queue
+            self.js_queue = []
+            self.js_flush_scheduled = False
+        if batch:
+            try:
+                data = json.dumps(batch)
+            except UnicodeDecodeError:
+                data = json.dumps(util.to_unicode(batch))   # a filename that is not valid UTF-8 - only it gets latin-1
+            self.web_view.execute_script('run_batch(%s)' % data)
+        return False
 
     def select_in_browser(self, path):
-        self.js("select('%s')" % (path if self.is_command(path) else util.path2url(path)))
+        self.js_call('select', path if self.is_command(path) else util.path2url(path))
 
     def update_zoom_scrolling(self):
         if self.zoom:
@@ -178,40 +323,362 @@ class Ojo():
             self.shown = filename
             self.selected = self.shown
             self.window.set_title(self.shown)
-            self.refresh_image()
+            self.refresh_image(quick)
 
             if not quick:
                 self.update_cursor()
                 self.select_in_browser(self.shown)
                 self.cache_around()
 
-    def refresh_image(self):
-        if self.shown:
+    def refresh_image(self, quick=False):
+        self.display_generation += 1    # drops any pending background decode
+        if self.shown and self.zoom and (self.zoom_scale != 1 or self.is_tiled(self.shown)):
+            self.stop_animation()
+            self.show_zoom_view()
+        elif self.shown:
+            self.zoom_view = None
+            self.set_image_widget(self.image)
+            anim = self.get_animation(self.shown)
+            if anim:
+                # no static decode needed, the frames come from the cached animation
+                self.show_animation(anim)
+                startuptrace.mark('decode')
+                self.increase_size()
+                self.box.set_visible(True)
+                return
+            self.stop_animation()
+            # at startup the full image is shown right away - the thumbnail lookup would only delay it
+            if not self.zoom and not quick and self.show_progressively():
+                return
             self.pixbuf = self.get_pixbuf(self.shown)
+            if not self.zoom:
+                self.offer_resize_master(self.shown, self.pixbuf)
+            startuptrace.mark('decode')
             self.increase_size()
-            if os.path.splitext(self.shown)[1].lower() in ('.gif', '.mng', '.png'):
-                anim = GdkPixbuf.PixbufAnimation.new_from_file(self.shown)
-                if anim.is_static_image():
-                    self.image.set_from_pixbuf(self.pixbuf)
-                else:
-                    self.image.set_from_animation(anim)
-            else:
-                self.image.set_from_pixbuf(self.pixbuf)
+            self.image.set_from_pixbuf(self.pixbuf)
             self.box.set_visible(True)
 
+    def get_animation(self, filename):
+        """The parsed animation of filename, or None if it is not animated. Parsed once, then cached."""
+        if not animation.may_be_animated(filename):
+            return None
+        cached = self.anim_cache.get(filename)
+        if cached is None:
+            try:
+                anim = GdkPixbuf.PixbufAnimation.new_from_file(filename)
+            except GObject.GError:
+                anim = None
+            if anim and anim.is_static_image():
+                anim = None     # remembered as static, shown like any other image
+            cached = anim, animation.animation_size(anim, filename) if anim else 0
+            self.anim_cache[filename] = cached
+        return cached[0]
+
+    def show_animation(self, anim):
+        """Plays anim as it is when it fits (or at 100% zoom), else with its frames scaled to fit the window"""
+        w, h = anim.get_width(), anim.get_height()
+        size = (w, h) if self.zoom else \
+            self.get_fit_size(w, h, self.get_max_image_width(), self.get_max_image_height())
+        player = self.animation_player
+        if size == (w, h):
+            self.stop_animation()
+            self.pixbuf = anim.get_static_image()
+            if self.image.get_storage_type() != Gtk.ImageType.ANIMATION or self.image.get_animation() is not anim:
+                self.image.set_from_animation(anim)
+        elif player and player.animation is anim:
+            player.set_size(size)   # e.g. on resize - the animation goes on where it was
+            self.pixbuf = player.frame
+        else:
+            self.stop_animation()
+            self.animation_player = animation.AnimationPlayer(self.shown, self.image, anim, size)
+            self.animation_player.start()
+            self.pixbuf = self.animation_player.frame
+
+    def stop_animation(self):
+        if self.animation_player:
+            self.animation_player.stop()
+            self.animation_player = None
+
+    def show_progressively(self):
+        """
+        Unless the fit-to-window pixbuf is already cached or the file is quick to decode anyway, shows the best cheap
+        rendition of the current image right away - the resize master, a lower mip, the thumbnail or an embedded
+        preview - and decodes the full one in the background. Returns False if there was nothing cheap to show.
+        """
+        filename = self.shown
+        width, height = self.get_max_image_width(), self.get_max_image_height()
+        cached = self.pix_cache[False].get(filename)
+        if cached and cached[1] == width:
+            return False
+        if not self.get_resize_master(filename) and not thumbnails.is_raw(filename):
+            try:
+                if os.path.getsize(filename) < PROGRESSIVE_MIN_FILE_SIZE:
+                    return False    # cheap enough to decode right away
+            except OSError:
+                return False
+
+        try:
+            quick = self.get_quick_pixbuf(filename, width, height)
+        except Exception:
+            logging.exception("Could not prepare a quick rendition of %s" % filename)
+            quick = None
+        if not quick:
+            return False
+
+        self.pixbuf = quick
+        startuptrace.mark('decode')
+        self.increase_size()
+        self.image.set_from_pixbuf(quick)
+        self.box.set_visible(True)
+        self.request_display_decode(filename, width, height)
+        return True
+
+    def get_quick_pixbuf(self, filename, width, height):
+        """A cheap, possibly blurry rendition of filename at its fit-to-window size, or None"""
+        fit_w, fit_h = self.get_fit_size(*(self.get_image_size(filename) + (width, height)))
+        chain = self.mip_cache.get(filename)
+        master = self.get_resize_master(filename)
+        if master:
+            source = master     # e.g. after a resize - as sharp as what was just shown
+        elif chain:
+            source = chain.get_level(float(fit_w) / chain.get_width())
+        else:
+            thumb = self.find_thumbnail(filename)
+            source = self.get_thumbnail_pixbuf(thumb) if thumb else \
+                self.get_preview_pixbuf(filename, fit_w // 4, fit_h // 4)
+        if not source:
+            return None
+        return source.scale_simple(fit_w, fit_h, GdkPixbuf.InterpType.BILINEAR)
+
+    def get_preview_pixbuf(self, filename, width, height):
+        """The smallest embedded preview covering width x height (or the largest one), auto-rotated"""
+        meta = self.get_meta(filename)
+        if not meta or not meta.previews:
+            return None
+        orientation = self.meta_cache[filename][4]
+        preview = thumbnails.select_preview(meta, width, height, orientation, fallback_to_largest=True)
+        return self.auto_rotate_pixbuf(orientation, self.pixbuf_from_data(preview.data)) if preview else None
+
+    def request_display_decode(self, filename, width, height):
+        """
+        Decodes filename at full quality in the display thread, which then swaps it in for the quick rendition.
+        Only the latest request matters - when flipping through images quickly, stale ones are skipped.
+        """
+        with self.display_lock:
+            self.display_request = filename, width, height, self.display_generation
+            if not self.display_thread:
+                self.display_thread = threading.Thread(target=self.display_decode_loop)
+                self.display_thread.daemon = True
+                self.display_thread.start()
+        self.display_event.set()
+
+    def display_decode_loop(self):
+        while True:
+            self.display_event.wait()
+            with self.display_lock:
+                request = self.display_request
+                self.display_request = None
+                self.display_event.clear()
+            if not request:
+                continue
+            filename, width, height, generation = request
+            if generation != self.display_generation:
+                continue
+            try:
+                pixbuf = self.get_pixbuf(filename, False, False, width, height)
+            except Exception:
+                logging.exception("Could not decode %s" % filename)
+                continue
+            GObject.idle_add(self.swap_in_pixbuf, filename, pixbuf, generation)
+
+    def swap_in_pixbuf(self, filename, pixbuf, generation):
+        if generation == self.display_generation and self.shown == filename and not self.zoom:
+            self.pixbuf = pixbuf
+            self.offer_resize_master(filename, pixbuf)
+            self.increase_size()
+            self.image.set_from_pixbuf(pixbuf)
+        return False
+
+    def set_image_widget(self, widget):
+        viewport = self.scroll_window.get_child()
+        current = viewport.get_child()
+        if current is not widget:
+            viewport.remove(current)
+            viewport.add(widget)
+
+    def is_tiled(self, filename):
+        """Whether filename is big enough to be shown through a tile pyramid at 100%, rather than as one pixbuf"""
+        meta = self.get_meta_info(filename)
+        return bool(meta and meta[2] and meta[3] and
+                    meta[2] * meta[3] > self.options['tiled_zoom_megapixels'] * 1000000)
+
+    def show_zoom_view(self):
+        """
+        Shows the current image at self.zoom_scale: big images through their tile pyramid, the rest from their mip
+        chain - either way, changing the scale redraws without decoding again.
+        """
+        if not self.zoom_view or self.zoom_view.filename != self.shown:
+            pyramid = None
+            if self.is_tiled(self.shown):
+                import tiles
+                meta = self.get_meta_info(self.shown)
+                size = (meta[3], meta[2]) if meta[4] in (5, 6, 7, 8) else (meta[2], meta[3])
+                pyramid = tiles.TilePyramid(self.get_tile_pyramid(self.shown, meta[4]), size)
+            if pyramid and not pyramid.has_failed():
+                # the fit-to-window rendition is shown scaled up until the tiles get ready
+                self.pixbuf = self.get_pixbuf(self.shown, zoom=False)
+                self.zoom_view = tiles.TiledView(
+                    self.shown, pyramid, self.options['tile_cache_mb'] * 1024 * 1024, self.pixbuf)
+                if not pyramid.is_complete():
+                    filename = self.shown
+                    self.zoom_view.watch_build(lambda: self.on_tile_pyramid_failed(filename))
+            else:
+                # without tiles, the mip chain of a big image starts from its fit-to-window rendition, blurry at 100%
+                import mipmap
+                self.zoom_view = mipmap.MipView(self.shown, self.get_mip_chain(self.shown))
+                self.pixbuf = self.zoom_view.chain.levels[0]
+        self.zoom_view.set_scale(self.zoom_scale)
+        self.set_image_widget(self.zoom_view.area)
+        self.box.set_visible(True)
+
+    def on_tile_pyramid_failed(self, filename):
+        if self.zoom_view and self.zoom_view.filename == filename:
+            self.zoom_view = None
+            if self.zoom and self.shown == filename:
+                self.refresh_image()    # shows the mip view instead
+
+    def get_mip_chain(self, filename):
+        import mipmap
+        chain = self.mip_cache.get(filename)
+        if chain is None:
+            # for tiled images, get_pixbuf() gives the fit-to-window rendition - still scaled as the full image
+            chain = mipmap.MipChain(self.get_pixbuf(filename, zoom=True), self.get_image_size(filename))
+            self.mip_cache[filename] = chain
+        return chain
+
+    def get_image_size(self, filename):
+        """Full size of filename once auto-rotated"""
+        meta = self.get_meta_info(filename)
+        if meta and meta[2] and meta[3]:
+            return (meta[3], meta[2]) if meta[4] in (5, 6, 7, 8) else (meta[2], meta[3])
+        format, width, height = GdkPixbuf.Pixbuf.get_file_info(filename)
+        return width, height
+
+    def get_current_scale(self):
+        """The scale the current image is displayed at, 1 meaning 100%"""
+        if self.zoom:
+            return self.zoom_scale
+        return float(self.pixbuf.get_width()) / self.get_image_size(self.shown)[0]
+
+    def zoom_by(self, factor, anchor_x=None, anchor_y=None):
+        self.zoom_to(self.get_current_scale() * factor, anchor_x, anchor_y)
+
+    def zoom_to(self, scale, anchor_x=None, anchor_y=None):
+        """
+        Zooms continuously to scale, keeping the image point under (anchor_x, anchor_y) in place.
+        The anchor is in scroll window coordinates and defaults to its center. Zooming out past the fit-to-window
+        scale goes back to fit-to-window.
+        """
+        if self.mode != 'image' or not self.shown:
+            return
+        self.register_action()
+        view_w = self.scroll_window.get_allocated_width()
+        view_h = self.scroll_window.get_allocated_height()
+        anchor_x = view_w / 2.0 if anchor_x is None else anchor_x
+        anchor_y = view_h / 2.0 if anchor_y is None else anchor_y
+        image_w, image_h = self.get_image_size(self.shown)
+        ha = self.scroll_window.get_hadjustment()
+        va = self.scroll_window.get_vadjustment()
+
+        def _image_point(scale, scroll, anchor, view, image):
+            # image coordinate (at 100%) under the anchor, given that smaller-than-view images are centered
+            return (scroll + anchor - max(0, (view - image * scale) / 2.0)) / scale
+
+        old_scale = self.get_current_scale()
+        x = _image_point(old_scale, ha.get_value() if self.zoom else 0, anchor_x, view_w, image_w)
+        y = _image_point(old_scale, va.get_value() if self.zoom else 0, anchor_y, view_h, image_h)
+
+        fit_scale = float(self.get_pixbuf(self.shown, zoom=False).get_width()) / image_w
+        if scale <= fit_scale:
+            self.set_zoom(False)
+            self.refresh_image()
+            self.update_zoomed_views()
+            self.update_cursor()
+            return
+
+        self.zoom = True
+        self.zoom_scale = min(MAX_ZOOM_SCALE, scale)
+        self.zoom_x_percent = self.zoom_y_percent = None
+        self.refresh_image()
+        self.update_zoomed_views()
+        # the adjustments only get the new image size with the next size-allocate, until then set_value() would be
+        # clamped to the old one - so the scrolling waits for it
+        if not self.zoom_scroll_target:
+            GObject.idle_add(self.apply_zoom_scroll)
+        self.zoom_scroll_target = (x * self.zoom_scale + max(0, (view_w - image_w * self.zoom_scale) / 2.0) - anchor_x,
+                                   y * self.zoom_scale + max(0, (view_h - image_h * self.zoom_scale) / 2.0) - anchor_y)
+        self.update_cursor()
+
+    def apply_zoom_scroll(self):
+        target = self.zoom_scroll_target
+        self.zoom_scroll_target = None
+        if target and self.zoom:
+            ha = self.scroll_window.get_hadjustment()
+            va = self.scroll_window.get_vadjustment()
+            ha.set_value(target[0])
+            va.set_value(target[1])
+            self.scroll_h = ha.get_value()
+            self.scroll_v = va.get_value()
+        return False
+
+    def get_tile_pyramid(self, filename, orientation):
+        """Returns the spill folder of filename's tile pyramid, starting to build it if needed"""
+        import hashlib
+        import tiles
+        root = os.path.join(self.get_cache_dir(), 'tiles')
+        spill_dir = os.path.join(root, hashlib.md5(filename + str(self.get_file_stat(filename)[1])).hexdigest())
+        error_marker = os.path.join(spill_dir, tiles.ERROR_NAME)
+        with self.building_pyramids_lock:
+            if os.path.exists(error_marker) and spill_dir not in self.retried_pyramids:
+                # failures can be passing (out of memory, disk full) - each gets one more try per session
+                self.retried_pyramids.add(spill_dir)
+                try:
+                    os.unlink(error_marker)
+                except OSError:
+                    pass
+            if spill_dir in self.building_pyramids or \
+                    any(os.path.exists(os.path.join(spill_dir, name)) for name in (tiles.DONE_NAME, tiles.ERROR_NAME)):
+                return spill_dir
+
+            # tiles take as much disk space as the decoded image - keep only the pyramids in use
+            tiles.prune_spill(root, self.building_pyramids | {spill_dir})
+            self.building_pyramids.add(spill_dir)
+
+        def _done(result):
+            spill_dir, error = result
+            with self.building_pyramids_lock:
+                self.building_pyramids.discard(spill_dir)
+            if error:
+                logging.warning("Could not build tiles for %s: %s" % (filename, error))
+
+        logging.info("Building tile pyramid for %s in %s" % (filename, spill_dir))
+        args = (filename, orientation, spill_dir)
+        if getattr(self, 'thumbs_pool', None):
+            # decoding such images takes a lot of memory - better done in a worker, which gives it back afterwards
+            self.thumbs_pool.apply_async(tiles.build_pyramid_job, args, callback=_done)
+        else:
+            build_thread = threading.Thread(target=lambda: _done(tiles.build_pyramid_job(*args)))
+            build_thread.daemon = True
+            build_thread.start()
+        return spill_dir
+
     def get_supported_image_extensions(self):
         if not hasattr(self, "image_formats"):
             # supported by PIL, as per http://infohost.nmt.edu/tcc/help/pubs/pil/formats.html:
             self.image_formats = {"bmp", "dib", "dcx", "eps", "ps", "gif", "im", "jpg", "jpe", "jpeg", "pcd",
                                   "pcx", "png", "pbm", "pgm", "ppm", "psd", "tif", "tiff", "xbm", "xpm"}
 
-            # RAW formats, as per https://en.wikipedia.org/wiki/Raw_image_format#Annotated_list_of_file_extensions,
-            # we rely on pyexiv2 previews for these:
-            self.image_formats = self.image_formats.union(
-                    {"3fr", "ari", "arw", "srf", "sr2", "bay", "crw", "cr2", "cap", "iiq",
-                     "eip", "dcs", "dcr", "drf", "k25", "kdc", "dng", "erf", "fff", "mef", "mos", "mrw",
-                     "nef", "nrw", "orf", "pef", "ptx", "pxn", "r3d", "raf", "raw", "rw2", "raw", "rwl",
-                     "dng", "rwz", "srw", "x3f"})
+            self.image_formats = self.image_formats.union(thumbnails.RAW_EXTENSIONS)
 
             # supported by GdkPixbuf:
             for l in [f.get_extensions() for f in GdkPixbuf.Pixbuf.get_formats()]:
@@ -219,28 +686,45 @@ class Ojo():
 
         return self.image_formats
 
+    def has_image_extension(self, filename):
+        return os.path.splitext(filename)[1].lower()[1:] in self.get_supported_image_extensions()
+
     def is_image(self, filename):
         """Decide if something might be a supported image based on extension"""
         try:
-            return os.path.isfile(filename) and \
-                   os.path.splitext(filename)[1].lower()[1:] in self.get_supported_image_extensions()
+            entry = self.folder_model.get(filename) if self.folder_model else None
+            is_file = entry.is_file if entry else os.path.isfile(filename)
+            return is_file and self.has_image_extension(filename)
         except Exception:
             return False
 
-    def get_image_list(self):
-        images = filter(self.is_image, map(lambda f: os.path.join(self.folder, f), os.listdir(self.folder)))
-        if not self.options['show_hidden']:
-            images = filter(lambda f: not os.path.basename(f).startswith('.'), images)
+    def get_file_stat(self, filename):
+        """(size, mtime) of filename, from the folder model when possible"""
+        entry = self.folder_model.get(filename) if self.folder_model else None
+        if entry:
+            return entry.size, entry.mtime
+        st = os.stat(filename)
+        return st.st_size, st.st_mtime
 
+    def get_image_sort_key(self):
+        model = self.folder_model
         if self.options['sort_by'] == 'name':
-            key = lambda f: os.path.basename(f).lower()
+            return lambda f: os.path.basename(f).lower()
         elif self.options['sort_by'] == 'date':
-            key = lambda f: os.stat(f).st_mtime
+            return lambda f: model.get(f).mtime
         elif self.options['sort_by'] == 'size':
-            key = lambda f: os.stat(f).st_size
+            return lambda f: model.get(f).size
         else:
-            key = lambda f: f
-        images = sorted(images, key=key)
+            return lambda f: f
+
+    def get_image_list(self):
+        images = filter(self.has_image_extension, self.folder_model.files())
+        if not self.options['show_hidden']:
+            images = filter(lambda f: not os.path.basename(f).startswith('.'), images)
+        return self.sort_images(images)
+
+    def sort_images(self, images):
+        images = sorted(images, key=self.get_image_sort_key())
         if self.options['sort_order'] == 'desc':
             images = list(reversed(images))
         return images
@@ -275,7 +759,110 @@ class Ojo():
         else:
             self.folder_history_position = modify_history_position
         self.search_text = ""
+        self.folder_model = scanner.scan_folder(path)
         self.images = self.get_image_list()
+        self.watch_folder(path)
+
+    def watch_folder(self, folder):
+        """Monitors folder (via inotify), so we can update the image list and browser in place"""
+        from gi.repository import Gio
+        if getattr(self, 'folder_monitor', None):
+            self.folder_monitor.cancel()
+        self.folder_changes = set()
+        try:
+            self.folder_monitor = Gio.File.new_for_path(folder).monitor_directory(Gio.FileMonitorFlags.NONE, None)
+            self.folder_monitor.connect('changed', self.on_folder_changed)
+        except Exception:
+            logging.exception("Could not monitor folder %s" % folder)
+            self.folder_monitor = None
+
+    def on_folder_changed(self, monitor, file, other_file, event_type):
+        from gi.repository import Gio
+        if event_type not in (Gio.FileMonitorEvent.CREATED,
+                              Gio.FileMonitorEvent.DELETED,
+                              Gio.FileMonitorEvent.CHANGES_DONE_HINT):
+            return
+        path = file.get_path()
+        if monitor != self.folder_monitor or not path or os.path.dirname(path) != self.folder:
+            return
+        # coalesce the bursts of events we get while files are being written
+        if not self.folder_changes:
+            GObject.timeout_add(500, self.apply_folder_changes)
+        self.folder_changes.add(path)
+
+    def apply_folder_changes(self):
+        changes = self.folder_changes
+        self.folder_changes = set()
+
+        def _is_image(entry):
+            return entry.is_file and self.has_image_extension(entry.path) and \
+                (self.options['show_hidden'] or not entry.name.startswith('.'))
+        added, removed, changed, folders_changed = self.folder_model.apply_changes(changes, self.images, _is_image)
+        for path in changed:
+            self.on_image_changed(path)
+        for path in removed:
+            self.on_image_removed(path)
+        for path in added:
+            self.on_image_added(path)
+
+        if folders_changed and self.mode == 'folder':
+            subfolders = self.filter_hidden(self.folder_model.folders())
+            self.refresh_category({'label': 'Subfolders', 'items': [self.get_folder_item(sub) for sub in subfolders]})
+        return False
+
+    def forget_image(self, path):
+        for cache in self.pix_cache.values():
+            cache.pop(path)
+        self.meta_cache.pop(path, None)
+        self.mip_cache.pop(path)
+        self.anim_cache.pop(path)
+        if self.get_resize_master(path):
+            self.resize_master = None
+        self.file_cache.pop(path)
+        if thumbnails.is_raw(path):
+            try:
+                self.file_cache.pop(self.get_readable_path(path))
+            except Exception:
+                pass
+        if hasattr(self, 'prepared_thumbs'):
+            self.prepared_thumbs.discard(path)
+
+    def on_image_added(self, path):
+        logging.info("Image added: %s" % path)
+        self.images = self.sort_images(self.images + [path])
+        pos = self.images.index(path)
+        before = util.path2url(self.images[pos + 1]) if pos + 1 < len(self.images) else None
+        self.js_call('insert_image_div', util.path2url(path), os.path.basename(path), 180, before)
+        self.priority_thumbs([path])
+
+    def on_image_removed(self, path):
+        logging.info("Image removed: %s" % path)
+        pos = self.images.index(path)
+        self.images = [f for f in self.images if f != path]    # a new list, other threads may be iterating the old
+        self.forget_image(path)
+        self.js_call('remove_image_div', util.path2url(path))
+        if path not in (self.selected, self.shown):
+            return
+        if self.images:
+            neighbour = self.images[min(pos, len(self.images) - 1)]
+            if self.mode == 'image' and path == self.shown:
+                self.show(neighbour)
+            else:
+                self.selected = neighbour
+        else:
+            # that was the last one - nothing left to show
+            self.selected = 'command:back'
+            if self.mode == 'image':
+                self.set_mode('folder')
+            self.shown = None
+            self.select_in_browser(self.selected)
+
+    def on_image_changed(self, path):
+        logging.info("Image changed: %s" % path)
+        self.forget_image(path)
+        self.priority_thumbs([path])
+        if self.mode == 'image' and path == self.shown:
+            self.refresh_image()
 
     def get_back_folder(self):
         i = self.folder_history_position
@@ -327,11 +914,51 @@ class Ojo():
         self.last_folder_change_time = time.time()
         self.render_folder_view()
 
+    def quit(self, *args):
+        if self.options_save_scheduled:
+            self.save_options_now()
+        if self.meta_index:
+            self.meta_index.flush()
+        for name, disk_cache in self.get_disk_caches():
+            disk_cache.flush()
+        if self.instance_server and self.options['keep_running'] and not killed:
+            # stay warm, with all caches, for the next launch to hand its file over to
+            self.window.hide()
+            return True
+        if self.instance_server:
+            self.instance_server.close()
+        Gtk.main_quit()
+
+    def start_instance_server(self):
+        import instance
+        server = instance.Server(lambda path: GObject.idle_add(self.open_handed_over, path))
+        try:
+            if server.start():
+                self.instance_server = server
+            else:
+                logging.info("Another Ojo is already running in single instance mode")
+        except Exception:
+            logging.exception("Could not start single instance server")
+
+    def open_handed_over(self, path):
+        """Shows the file or folder another launch of Ojo handed over, reusing everything already loaded"""
+        logging.info("Handed over: %s" % path)
+        if path and os.path.isdir(path):
+            self.change_to_folder(path)
+        elif path and os.path.isfile(path):
+            if os.path.dirname(path) != self.folder:
+                self.set_folder(os.path.dirname(path))
+                self.render_folder_view()
+            self.selected = path
+            self.set_mode('image')
+        self.window.present()
+        return False
+
     def check_kill(self):
         global killed
         if killed:
             logging.info('Killed, quitting...')
-            GObject.idle_add(Gtk.main_quit)
+            GObject.idle_add(self.quit)
         else:
             GObject.timeout_add(500, self.check_kill)
 
@@ -342,7 +969,7 @@ class Ojo():
         last_y = getattr(self, "last_y", 0)
 
         if (event.width, event.height, event.x, event.y) != (last_width, last_height, last_x, last_y):
-            GObject.idle_add(self.refresh_image)
+            self.schedule_resize((event.width, event.height) != (last_width, last_height))
             if time.time() - self.last_automatic_resize > 0.5:
                 logging.info("Manually resized, stop automatic resizing")
                 self.manually_resized = True
@@ -352,21 +979,63 @@ class Ojo():
         self.last_x = event.x
         self.last_y = event.y
 
+    def schedule_resize(self, size_changed):
+        """
+        Debounces configure events: while they keep coming (e.g. dragging a window edge), the image is only scaled
+        roughly from its master rendition, once per frame. refresh_image() runs once they settle.
+        """
+        if self.resize_timer:
+            GObject.source_remove(self.resize_timer)
+        self.resize_timer = GObject.timeout_add(RESIZE_SETTLE_MS, self.resize_settled)
+        if size_changed and not self.interim_resize_pending:
+            self.interim_resize_pending = True
+            GObject.idle_add(self.interim_resize)
+
+    def interim_resize(self):
+        self.interim_resize_pending = False
+        master = self.get_resize_master(self.shown)
+        if master and not self.zoom and not self.animation_player and not self.zoom_view:
+            fit_w, fit_h = self.get_fit_size(*(self.get_image_size(self.shown) +
+                                               (self.get_max_image_width(), self.get_max_image_height())))
+            if (fit_w, fit_h) != (self.pixbuf.get_width(), self.pixbuf.get_height()):
+                self.pixbuf = master.scale_simple(fit_w, fit_h, GdkPixbuf.InterpType.NEAREST)
+                self.image.set_from_pixbuf(self.pixbuf)
+        return False
+
+    def resize_settled(self):
+        self.resize_timer = None
+        self.refresh_image()
+        return False
+
+    def get_resize_master(self, filename):
+        master = self.resize_master
+        return master[1] if master and master[0] == filename else None
+
+    def offer_resize_master(self, filename, pixbuf):
+        """Keeps pixbuf as the master rendition of filename if it is the largest one shown so far"""
+        master = self.get_resize_master(filename)
+        if not master or pixbuf.get_width() > master.get_width():
+            self.resize_master = filename, pixbuf
+
     def window_state_changed(self, widget, event):
         self.options['maximized'] = event.new_window_state & Gdk.WindowState.MAXIMIZED != 0
         self.save_options()
 
     def after_quick_start(self):
+        startuptrace.mark('after_quick_start')
         import signal
         signal.signal(signal.SIGINT, kill)
         signal.signal(signal.SIGTERM, kill)
         signal.signal(signal.SIGQUIT, kill)
 
         self.check_kill()
+        if self.options['single_instance']:
+            self.start_instance_server()
         self.folder_history = []
         self.folder_history_position = 0
 
         self.set_folder(os.path.dirname(self.selected))
+        self.open_meta_index()
 
         self.update_cursor()
         self.from_browser_time = 0
@@ -376,14 +1045,21 @@ class Ojo():
         self.make_transparent(self.browser)
         self.box.add(self.browser)
 
-        self.window.connect("delete-event", Gtk.main_quit)
+        self.window.connect("delete-event", self.quit)
         self.window.connect("key-press-event", self.process_key)
         if "--quit-on-focus-out" in sys.argv:
-            self.window.connect("focus-out-event", Gtk.main_quit)
+            self.window.connect("focus-out-event", self.quit)
         self.window.connect("button-press-event", self.mousedown)
         self.last_mouseup_time = 0
         self.window.connect("button-release-event", self.mouseup)
         self.window.connect("scroll-event", self.scrolled)
+        # before the scroll window gets to scroll with it
+        self.scroll_window.connect("scroll-event", self.zoom_scrolled)
+        if hasattr(Gtk, 'GestureZoom'):  # GTK 3.14+
+            self.zoom_gesture = Gtk.GestureZoom.new(self.scroll_window)
+            self.zoom_gesture.connect(
+                'begin', lambda *args: setattr(self, 'pinch_start_scale', self.get_current_scale()))
+            self.zoom_gesture.connect('scale-changed', self.pinch_zoom)
         self.window.connect('motion-notify-event', self.mouse_motion)
 
         self.window.connect('configure-event', self.resized)
@@ -393,12 +1069,19 @@ class Ojo():
 
         GObject.idle_add(self.render_browser)
 
+        # forks the workers while other threads (e.g. the display decode thread) may already be running - safe, as
+        # the workers only run thumbnails.thumbnail_job, which does not use any lock they inherit from us
+        self.start_thumbnail_pool()
         self.start_cache_thread()
+        self.start_read_thread()
         if self.mode == "image":
             self.cache_around()
         self.start_thumbnail_thread()
+        self.start_thumb_cache_gc()
+        startuptrace.mark('after_quick_start done')
 
     def load_options(self):
+        self.options_save_scheduled = False
         self.options = self.load_json('options.json', {})
         defaults = {
             'decorated': True,
@@ -411,7 +1094,25 @@ class Ojo():
             'sort_order': 'asc',
             'show_hidden': False,
 
-            'folder': util.get_xdg_pictures_folder()
+            'pixbuf_cache_mb': 1024,
+            'thumbnail_workers': 0,     # 0 means one per CPU core
+            'thumbnail_mode': 'embedded',   # 'full', 'embedded' (use embedded previews when big enough) or 'quick'
+            'freedesktop_thumbnails': 'read',   # use ~/.cache/thumbnails: 'off', 'read' or 'readwrite'
+            'thumbnail_cache_mb': 500,  # thumbnail files - with packs, only the ones still to be packed
+            'thumbnail_pack_mb': 500,
+            'thumbnail_cache_days': 180,    # thumbnails (and RAW previews) not shown for this long get deleted
+            'thumbnail_store': 'pack',  # 'pack' (one packed file per folder) or 'files' (one file per thumbnail)
+            'raw_preview_cache_mb': 2048,
+            'tiled_zoom_megapixels': 50,    # bigger images are shown through tiles at 100%
+            'tile_cache_mb': 128,
+            'mip_cache_mb': 256,
+            'animation_cache_mb': 128,
+            'file_cache_mb': 256,
+            'file_cache_window': 50,    # file bytes are kept for this many images before and after the current one
+            'single_instance': False,   # later launches open their file in this window, see instance.py
+            'keep_running': False,      # in single instance mode, closing the window only hides it
+
+            'folder': None  # the XDG pictures folder - looked up only when needed, it takes spawning xdg-user-dir
         }
         for k, v in defaults.items():
             if not k in self.options:
@@ -422,21 +1123,33 @@ class Ojo():
             lambda f: not os.path.basename(f).startswith('.'), files)
 
     def save_options(self):
+        """Options often change in bursts and writing them should not hold up the UI, so saving is delayed"""
+        if not self.options_save_scheduled:
+            self.options_save_scheduled = True
+            GObject.timeout_add(OPTIONS_SAVE_DELAY_MS, self.save_options_now)
+
+    def save_options_now(self):
+        self.options_save_scheduled = False
         self.save_json('options.json', self.options)
+        return False
 
     def load_bookmarks(self):
-        self.bookmarks = self.load_json('bookmarks.json', [util.get_xdg_pictures_folder()])
+        # xdg-user-dir runs in a subprocess - only worth it when there are no bookmarks yet
+        self.bookmarks = self.load_json('bookmarks.json', lambda: [util.get_xdg_pictures_folder()])
 
     def save_bookmarks(self):
         self.save_json('bookmarks.json', self.bookmarks)
 
     def load_json(self, filename, default_data):
+        """default_data can also be a function returning it, for defaults that are costly to compute"""
         import json
         try:
             with open(self.get_config_file(filename)) as f:
                 return json.load(f)
         except Exception:
             logging.exception("Could not load options, using defaults")
+            if callable(default_data):
+                default_data = default_data()
             self.save_json(filename, default_data)
             return default_data
 
@@ -453,13 +1166,11 @@ class Ojo():
     def update_selected_info(self, filename):
         if self.selected != filename or not os.path.isfile(filename):
             return
-        if not filename in self.meta_cache:
-            self.get_meta(filename)
-        if filename in self.meta_cache:    # get_meta() might have failed
-            meta = self.meta_cache[filename]
+        meta = self.get_meta_info(filename)
+        if meta:    # get_meta() might have failed
             rok = not meta[1]
-            self.js("set_dimensions('%s', '%s', '%d x %d')" % (
-                util.path2url(filename), os.path.basename(filename), meta[2 if rok else 3], meta[3 if rok else 2]))
+            self.js_call('set_dimensions', util.path2url(filename), os.path.basename(filename),
+                         '%d x %d' % (meta[2 if rok else 3], meta[3 if rok else 2]))
 
     def is_command(self, s):
         return s.startswith('command:')
@@ -478,7 +1189,7 @@ class Ojo():
                     if os.path.isfile(path):
                         self.set_mode('image')
                 GObject.idle_add(_do)
-        elif action == 'ojo-priority':
+        elif action == 'ojo-visible':
             files = json.loads(argument)
             self.priority_thumbs(map(lambda f: util.url2path(f.encode('utf-8')), files))
         elif action == 'ojo-handle-key':
@@ -493,6 +1204,7 @@ class Ojo():
             html = f.read()
 
         self.web_view = WebKit.WebView()
+        startuptrace.mark('webkit')
         self.web_view.set_transparent(True)
         self.web_view.set_can_focus(True)
 
@@ -506,7 +1218,10 @@ class Ojo():
                 self.on_js_action(action, argument)
         self.web_view.connect("status-bar-text-changed", nav)
 
-        self.web_view.connect('document-load-finished', lambda wf, data: self.render_folder_view())
+        def _loaded(*args):
+            startuptrace.mark('browser loaded')
+            self.render_folder_view()
+        self.web_view.connect('document-load-finished', _loaded)
         self.web_view.load_string(html, "text/html", "UTF-8", util.path2url(ojoconfig.get_data_path()) + '/')
 
         self.make_transparent(self.web_view)
@@ -617,20 +1332,18 @@ class Ojo():
         return {'label': 'Options', 'items': items}
 
     def refresh_category(self, category):
-        import json
-        self.js('refresh_category(%s)' % json.dumps(category))
+        self.js_call('refresh_category', category)
 
     def render_folder_view(self):
         self.web_view_loaded = True
+        self.schedule_js_flush()
         self.loading_folder = True
         thread_change_time = self.last_folder_change_time
         thread_folder = self.folder
-        self.js("change_folder('%s')" % util.path2url(self.folder))
-
-        import threading
-        import json
+        self.js_call('change_folder', util.path2url(self.folder))
 
         def _thread():
+            self.preload_folder_meta(thread_folder)
             parent_folder = self.get_parent_folder()
 
             nav_items = [
@@ -643,15 +1356,13 @@ class Ojo():
 
             # Siblings
             if parent_folder:
-                siblings = self.filter_hidden([os.path.join(parent_folder, f) for f in sorted(os.listdir(parent_folder))
-                            if os.path.isdir(os.path.join(parent_folder, f))])
+                siblings = self.filter_hidden(scanner.list_subfolders(parent_folder))
                 pos = siblings.index(self.folder)
                 if pos + 1 < len(siblings):
                     categories .append({'label': 'Next sibling', 'items': [self.get_folder_item(siblings[pos + 1])]})
 
             # Subfolders
-            subfolders = self.filter_hidden([os.path.join(self.folder, f) for f in sorted(os.listdir(self.folder))
-                                             if os.path.isdir(os.path.join(self.folder, f))])
+            subfolders = self.filter_hidden(self.folder_model.folders())
             if subfolders:
                 categories.append({'label': 'Subfolders', 'items': [self.get_folder_item(sub) for sub in subfolders]})
 
@@ -665,88 +1376,169 @@ class Ojo():
 
             if self.last_folder_change_time != thread_change_time or thread_folder != self.folder:
                 return
-            self.js("render_folders(%s)" % json.dumps(folder_info))
+            self.js_call('render_folders', folder_info)
             self.select_in_browser(self.selected)
 
             pos = self.images.index(self.selected) if self.selected in self.images else 0
             self.priority_thumbs([x[1] for x in sorted(enumerate(self.images), key=lambda (i,f): abs(i - pos))])
 
+            self.js_call('add_image_divs', [
+                [util.path2url(img), os.path.basename(img), img == self.selected, 180] for img in self.images])
+
             for img in self.images:
                 if self.last_folder_change_time != thread_change_time or thread_folder != self.folder:
                     return
-                self.js("add_image_div('%s', '%s', %s, %d)" % (
-                    util.path2url(img), os.path.basename(img), 'true' if img==self.selected else 'false', 180))
-                time.sleep(0.001)
-                cached = self.get_cached_thumbnail_path(img)
-                if os.path.exists(cached):
+                cached = self.find_thumbnail(img)
+                if cached:
                     self.add_thumb(img, use_cached=cached)
                 else:
                     try:
-                        meta = self.get_meta(img)
-                        w, h = meta.dimensions
-                        rok = not self.needs_rotation(meta)
-                        thumb_width = round(w * 120 / h) if rok else round(h * 120 / w)
+                        if self.options['thumbnail_mode'] == 'quick':
+                            # nothing that parses files here - the thumbs thread shows the embedded previews
+                            if img not in self.meta_cache:
+                                self.load_indexed_meta(img)
+                            meta = self.meta_cache.get(img)
+                        else:
+                            meta = self.get_meta_info(img)
+                        w, h = meta[2], meta[3]
+                        rok = not meta[1]
                         if w and h:
-                            self.js("set_dimensions('%s', '%s', '%d x %d', %d)" % (
-                                util.path2url(img), os.path.basename(img), w if rok else h, h if rok else w, thumb_width))
+                            self.js_call('set_dimensions', util.path2url(img), os.path.basename(img),
+                                         '%d x %d' % (w if rok else h, h if rok else w), self.get_thumb_width(img))
                     except Exception:
                         pass
 
             self.select_in_browser(self.selected)
 
             self.loading_folder = False
+            if self.meta_index:
+                self.meta_index.flush()
 
         prepare_thread = threading.Thread(target=_thread)
         prepare_thread.daemon = True
         prepare_thread.start()
 
+    def create_pix_cache(self):
+        total = self.options['pixbuf_cache_mb'] * 1024 * 1024
+        return {
+            False: LruCache(int(total * (1 - ZOOM_CACHE_SHARE)), sizeof=pixbuf_size),
+            True: LruCache(int(total * ZOOM_CACHE_SHARE), sizeof=pixbuf_size)}
+
     def cache_around(self):
         if not hasattr(self, "images") or not self.images:
             return
-        pos = self.images.index(self.selected) if self.selected in self.images else 0
-        for i in [1, -1]:
-            if pos + i < 0 or pos + i >= len(self.images):
+        applicable = self.get_applicable_images()
+        if not applicable:
+            return
+        pos = applicable.index(self.selected) if self.selected in applicable else 0
+        window = []
+        for offset in self.navigation.get_offsets():
+            f = applicable[(pos + offset) % len(applicable)]
+            if f != self.selected and not f in window:
+                window.append(f)
+        for cache in self.pix_cache.values():
+            cache.set_protected([self.selected] + window)
+        # the image on screen goes first, then its neighbours in the order the prefetch window gives them
+        requests = [(f, self.zoom) for f in [self.selected] + window if not f in self.pix_cache[self.zoom]]
+        logging.info("Caching around: %d files, zoomed %s" % (len(requests), self.zoom))
+        self.decode_queue.submit(requests)
+        self.read_around(applicable, pos)
+
+    def read_around(self, applicable, pos):
+        """
+        Queues reading the bytes of the files in the file_cache_window around pos, the closest ones first. The window
+        ends where the files would no longer fit in the cache together - else reading the far ones would push out the
+        near ones, only for them to be read again on the next step.
+        """
+        window = self.options['file_cache_window']
+        direction = self.navigation.get_direction()
+        offsets = sorted(range(-window, window + 1), key=lambda o: (abs(o), o * direction < 0))
+        paths = []
+        total = 0
+        for offset in offsets[:len(applicable)]:
+            path = self.get_readable_path(applicable[(pos + offset) % len(applicable)])
+            if not path or path in paths:
                 continue
-            f = self.images[pos + i]
-            if not f in self.pix_cache[self.zoom]:
-                logging.info("Caching around: file %s, zoomed %s" % (f, self.zoom))
-                self.cache_queue.put((f, self.zoom))
+            try:
+                size = self.get_file_stat(path)[0]
+            except OSError:
+                continue
+            if size > self.file_cache.max_bytes // 8:
+                continue    # never read, see start_read_thread()
+            total += size
+            if total > self.file_cache.max_bytes:
+                break
+            paths.append(path)
+        self.file_cache.set_protected(paths)
+        self.read_queue.submit([p for p in paths if not p in self.file_cache])
+
+    def get_readable_path(self, filename):
+        """The file get_pixbuf() decodes filename from - for RAW files their extracted preview, if there is one"""
+        if animation.may_be_animated(filename):
+            return None     # parsed from the file by PixbufAnimation
+        if thumbnails.is_raw(filename):
+            try:
+                cached = self.preview_cache.path_for(filename, self.get_file_stat(filename)[1])
+            except OSError:
+                return None
+            return cached if os.path.exists(cached) else None
+        return filename
+
+    def start_read_thread(self):
+        def _read_thread():
+            while True:
+                path, generation = self.read_queue.get()
+                if path in self.file_cache:
+                    continue
+                try:
+                    if os.path.getsize(path) > self.file_cache.max_bytes // 8:
+                        continue    # would push out too many others
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                    if self.read_queue.is_wanted(path, generation):
+                        self.file_cache[path] = data
+                except (IOError, OSError):
+                    logging.debug("Could not read %s" % path)
+                except Exception:
+                    logging.exception("Exception in read thread:")
+        read_thread = threading.Thread(target=_read_thread)
+        read_thread.daemon = True
+        read_thread.start()
 
     def start_cache_thread(self):
         import threading
-        import Queue
-        self.cache_queue = Queue.Queue()
-        self.preparing_event = threading.Event()
 
         def _queue_thread():
             logging.info("Starting cache thread")
             while True:
-                if len(self.pix_cache[False]) > 20:   # TODO: Do we want a proper LRU policy, or this is good enough?
-                    self.pix_cache[False] = {}
-                if len(self.pix_cache[True]) > 20:
-                    self.pix_cache[True] = {}
-
-                path, zoom = self.cache_queue.get()
+                key, generation = self.decode_queue.get()
+                path, zoom = key
 
                 try:
-                    if not path in self.pix_cache[zoom]:
+                    # skip what is cached meanwhile or being decoded for display right now;
+                    # animations are only parsed, refresh_image() never needs a static rendition of them
+                    if self.get_animation(path):
+                        continue
+                    if not path in self.pix_cache[zoom] and not self.decode_queue.is_running(key):
                         logging.debug("Cache thread loads file %s, zoomed %s" % (path, zoom))
-                        self.current_preparing = path, zoom
                         try:
-                            self.get_pixbuf(path, force=True, zoom=zoom)
+                            self.get_pixbuf(path, force=True, zoom=zoom,
+                                            cancelled=lambda: not self.decode_queue.is_wanted(key, generation))
+                        except DecodeCancelled:
+                            logging.debug("Cache thread dropped file %s, no longer needed" % path)
                         except Exception:
                             logging.exception("Could not cache file " + path)
-                        finally:
-                            self.current_preparing = None
-                            self.preparing_event.set()
                 except Exception:
                     logging.exception("Exception in cache thread:")
         cache_thread = threading.Thread(target=_queue_thread)
         cache_thread.daemon = True
         cache_thread.start()
 
+    def get_cache_dir(self):
+        return os.path.expanduser('~/.config/ojo/cache')
+
     def get_thumbs_cache_dir(self, height):
-        return os.path.expanduser('~/.config/ojo/cache/%d' % height)
+        return os.path.join(self.get_cache_dir(), str(height))
 
     def get_config_dir(self):
         return util.makedirs(os.path.expanduser('~/.config/ojo/config/'))
@@ -754,9 +1546,23 @@ class Ojo():
     def get_config_file(self, filename):
         return os.path.join(self.get_config_dir(), filename)
 
+    def start_thumbnail_pool(self):
+        import multiprocessing
+        import threading
+        workers = self.options['thumbnail_workers'] or multiprocessing.cpu_count()
+        try:
+            self.thumbs_pool = multiprocessing.Pool(workers, thumbnails.init_worker)
+            logging.info("Started thumbnail pool with %d workers" % workers)
+        except Exception:
+            logging.exception("Could not start thumbnail pool, will prepare thumbnails in-process")
+            self.thumbs_pool = None
+        # keep only a couple of jobs per worker submitted, so that priority changes take effect quickly
+        self.thumbs_in_flight = threading.BoundedSemaphore(2 * workers)
+
     def start_thumbnail_thread(self):
         import threading
         self.prepared_thumbs = set()
+        self.thumbs_retry = set()   # failed in the pool, to be tried again in-process
         self.thumbs_queue = []
         self.thumbs_queue_event = threading.Event()
         self.thumbs_queue_lock = threading.Lock()
@@ -777,11 +1583,16 @@ class Ojo():
             logging.info("Starting thumbs thread")
             while True:
                 self.thumbs_queue_event.wait()
+                self.thumbs_queue_event.clear()     # before emptying the queue, so that no later addition is missed
                 while self.thumbs_queue:
                     # pause thumbnailing while the user is actively cycling images:
                     while time.time() - self.last_action_time < 2 and self.mode == "image":
                         time.sleep(0.2)
-                    time.sleep(0.05)
+                    if self.thumbs_pool:
+                        self.thumbs_in_flight.acquire()
+                    else:
+                        time.sleep(0.05)
+                    submitted = False
                     try:
                         with self.thumbs_queue_lock:
                             if not self.thumbs_queue:
@@ -790,24 +1601,204 @@ class Ojo():
                             self.thumbs_queue.remove(img)
                         if not img in self.prepared_thumbs:
                             logging.debug("Thumbs thread loads file " + img)
-                            self.add_thumb(img)
+                            if self.options['thumbnail_mode'] == 'quick' and img not in self.thumbs_retry and \
+                                    self.show_embedded_thumb(img):
+                                pass
+                            elif self.thumbs_pool and img not in self.thumbs_retry:
+                                submitted = self.submit_thumb(img)
+                            else:
+                                self.add_thumb(img)
                     except Exception:
                         logging.exception("Exception in thumbs thread:")
-                self.thumbs_queue_event.clear()
+                    finally:
+                        if self.thumbs_pool and not submitted:
+                            self.thumbs_in_flight.release()
         thumbs_thread = threading.Thread(target=_thumbs_thread)
         thumbs_thread.daemon = True
         thumbs_thread.start()
 
+    def get_thumb_width(self, img):
+        """Width of the 120px high thumbnail of img, so the browser can lay it out before it loads, or None"""
+        meta = self.meta_cache.get(img)
+        if not meta or not meta[2] or not meta[3]:
+            return None
+        w, h = (meta[3], meta[2]) if meta[1] else (meta[2], meta[3])
+        return min(360, int(round(w * min(1.0, 120.0 / h))))
+
+    def find_thumbnail(self, img):
+        """
+        An existing thumbnail for img, or None: a thumbpack.Packed from the folder's thumbnail pack, or the path of one
+        in our own cache or in the shared freedesktop.org one. Only looks - filing thumbnails is up to add_thumb().
+        """
+        packed = self.get_packed_thumbnail(img)
+        if packed:
+            return packed
+        cached = self.get_cached_thumbnail_path(img)
+        if self.uses_thumb_packs() and self.thumb_cache.owns(cached):
+            # not packed yet, and it could be any moment - so it is read right away instead of handing out the path
+            import thumbpack
+            with self.thumb_store_lock:
+                try:
+                    with open(cached, 'rb') as f:
+                        return thumbpack.Packed(f.read(), cached)
+                except IOError:
+                    pass
+            packed = self.get_packed_thumbnail(img)    # packed meanwhile
+            if packed:
+                return packed
+        elif os.path.exists(cached):
+            return cached
+        if self.options['freedesktop_thumbnails'] != 'off':
+            try:
+                return xdgthumbs.lookup(img, self.get_file_stat(img)[1], 120)
+            except Exception:
+                logging.exception("Could not look up shared thumbnail for %s" % img)
+        return None
+
+    def uses_thumb_packs(self):
+        return self.options['thumbnail_store'] == 'pack'
+
+    def get_packed_thumbnail(self, img):
+        if not self.uses_thumb_packs():
+            return None
+        import thumbpack
+        size, mtime = self.get_file_stat(img)
+        data = self.thumb_packs.get(img, mtime, size)
+        return thumbpack.Packed(data) if data is not None else None
+
+    def store_thumbnail(self, img, thumb):
+        """
+        Files a thumbnail of img that is in our own cache, freshly made or found there. When thumbnails are packed,
+        it is moved into img's folder pack and returned as a thumbpack.Packed, otherwise its use gets recorded.
+        Anything else is returned as it is.
+        """
+        import thumbpack
+        if isinstance(thumb, thumbpack.Packed):
+            if not thumb.path:
+                return thumb
+            thumb = thumb.path  # read by find_thumbnail(), still to be packed
+        if not self.thumb_cache.owns(thumb):
+            return thumb
+        if not self.uses_thumb_packs():
+            self.thumb_cache.record_use(thumb, img, self.get_file_stat(img)[1])
+            return thumb
+        with self.thumb_store_lock:
+            packed = self.get_packed_thumbnail(img)
+            if packed and not os.path.exists(thumb):
+                return packed   # another thread was faster
+            with open(thumb, 'rb') as f:
+                data = f.read()
+            try:
+                size, mtime = self.get_file_stat(img)
+                self.thumb_packs.put(img, mtime, size, data)
+                os.unlink(thumb)
+            except Exception:
+                logging.exception("Could not pack thumbnail of %s" % img)
+            return thumbpack.Packed(data)
+
+    def get_thumbnail_url(self, thumb):
+        """Packed thumbnails reach the browser inline, as data URIs"""
+        import thumbpack
+        return thumb.to_data_uri() if isinstance(thumb, thumbpack.Packed) else util.path2url(thumb)
+
+    def get_thumbnail_pixbuf(self, thumb):
+        import thumbpack
+        if isinstance(thumb, thumbpack.Packed):
+            return self.pixbuf_from_data(thumb.data)
+        return GdkPixbuf.Pixbuf.new_from_file(thumb)
+
+    def get_shared_thumbnails_app(self):
+        """Our name in the shared thumbnail cache if we should write to it, None otherwise"""
+        return 'ojo-' + ojoconfig.__version__ if self.options['freedesktop_thumbnails'] == 'readwrite' else None
+
+    def is_thumbnail_failed(self, img):
+        """Whether any application recorded in the shared cache that it failed on img - our name is only for writing"""
+        return self.options['freedesktop_thumbnails'] != 'off' and \
+            xdgthumbs.is_failed(img, self.get_file_stat(img)[1])
+
+    def save_thumbnail_failure(self, img):
+        app = self.get_shared_thumbnails_app()
+        if app:
+            try:
+                xdgthumbs.save_failure(img, self.get_file_stat(img)[1], app)
+            except Exception:
+                logging.exception("Could not record thumbnail failure for %s" % img)
+
+    def submit_thumb(self, img):
+        """Sends img to the thumbnail pool, returns False if it was handled without the pool"""
+        cached = self.find_thumbnail(img)
+        if cached or self.is_thumbnail_failed(img) or \
+                os.path.splitext(img)[1].lower() in ('.gif', '.png', '.svg', '.xpm'):
+            # already prepared, known to fail, or a format we prefer to render with GdkPixbuf
+            self.add_thumb(img, use_cached=cached)
+            return False
+
+        def _done(result):
+            self.thumbs_in_flight.release()
+            filename, thumb_path, error = result
+            if thumb_path:
+                self.add_thumb(filename, use_cached=thumb_path)
+            else:
+                # runs in the pool's result thread, which must not be held up - the thumbs thread retries it
+                logging.debug("Thumbnail pool failed for %s (%s), retrying in-process" % (filename, error))
+                with self.thumbs_queue_lock:
+                    self.thumbs_retry.add(filename)
+                    self.thumbs_queue.insert(0, filename)
+                    self.thumbs_queue_event.set()
+
+        meta = self.meta_cache.get(img)
+        orientation = (meta[4] or 1) if meta else None  # None makes the worker read it itself
+        self.thumbs_pool.apply_async(
+            thumbnails.thumbnail_job,
+            (img, self.get_cached_thumbnail_path(img), 360, 120, orientation, self.get_thumbnail_mode(),
+             self.get_shared_thumbnails_app()),
+            callback=_done)
+        return True
+
     def add_thumb(self, img, use_cached=None):
         try:
-            thumb_path = use_cached or self.prepare_thumbnail(img, 360, 120)
-            self.js("add_image('%s', '%s')" % (util.path2url(img), util.path2url(thumb_path)))
+            thumb = self.store_thumbnail(img, use_cached or self.prepare_thumbnail(img, 360, 120))
+            self.js_call('add_image', util.path2url(img), self.get_thumbnail_url(thumb), self.get_thumb_width(img))
             if img == self.selected:
                 self.select_in_browser(img)
             self.prepared_thumbs.add(img)
         except Exception:
-            self.js("remove_image_div('%s')" % util.path2url(img))
+            self.js_call('remove_image_div', util.path2url(img))
             logging.warning("Could not add thumb for " + img)
+            if not use_cached:
+                self.save_thumbnail_failure(img)
+
+    def get_thumbnail_mode(self):
+        # in quick mode we already showed whatever embedded preview there was, now we want a proper thumbnail
+        return 'full' if self.options['thumbnail_mode'] == 'full' else 'embedded'
+
+    def show_embedded_thumb(self, img):
+        """
+        Quick mode: shows the embedded preview of img in the browser, before a proper thumbnail gets prepared.
+        Returns True if the preview was big enough to become the final thumbnail.
+        """
+        try:
+            if self.find_thumbnail(img):
+                return False    # the usual path takes it from there
+            cached = self.get_cached_thumbnail_path(img)
+            full_meta = self.get_meta(img)
+            if not full_meta:
+                return False
+            orientation = self.meta_cache[img][4]
+            preview = thumbnails.select_preview(full_meta, 360, 120, orientation)
+            if preview:
+                pil = thumbnails.fit_pil(thumbnails.preview_image(preview), orientation, 360, 120)
+                thumbnails.save_thumbnail(pil, cached, '.jpg')
+                self.add_thumb(img, use_cached=cached)
+                return True
+
+            preview = thumbnails.select_preview(full_meta, 360, 120, orientation, fallback_to_largest=True)
+            if preview:
+                pil = thumbnails.fit_pil(thumbnails.preview_image(preview), orientation, 360, 120)
+                self.js_call('add_image', util.path2url(img), 'data:image/png;base64,' + self.pil_to_base64(pil))
+        except Exception:
+            logging.exception("Could not show embedded preview for %s" % img)
+        return False
 
     def priority_thumbs(self, files):
         logging.debug("Priority thumbs: " + str(files))
@@ -828,11 +1819,63 @@ class Ojo():
                                         meta.dimensions[0], \
                                         meta.dimensions[1], \
                                         meta['Exif.Image.Orientation'].value if 'Exif.Image.Orientation' in meta else None
+            if self.meta_index:
+                size, mtime = self.get_file_stat(filename)
+                self.meta_index.put(filename, size, mtime, self.meta_cache[filename])
             return meta
         except Exception:
             logging.exception("Could not parse meta-info for %s" % filename)
             return None
 
+    def get_meta_info(self, filename):
+        """The meta_cache tuple for filename - from memory, from the persistent index, or by parsing the file"""
+        if not filename in self.meta_cache and not self.load_indexed_meta(filename):
+            self.get_meta(filename)
+        return self.meta_cache.get(filename)
+
+    def load_indexed_meta(self, filename):
+        """Copies filename's entry from the persistent index into meta_cache, returns False if there is none"""
+        if not self.meta_index:
+            return False
+        try:
+            size, mtime = self.get_file_stat(filename)
+            info = self.meta_index.get(filename, size, mtime)
+        except Exception:
+            logging.exception("Could not read meta index for %s" % filename)
+            return False
+        if info:
+            self.meta_cache[filename] = info
+        return info is not None
+
+    def preload_folder_meta(self, folder):
+        if not self.meta_index:
+            return
+        try:
+            for path, (size, mtime, info) in self.meta_index.load_folder(folder).items():
+                try:
+                    valid = self.get_file_stat(path) == (size, mtime)
+                except OSError:
+                    valid = False
+                if valid:
+                    self.meta_cache[path] = info
+        except Exception:
+            logging.exception("Could not preload meta index for %s" % folder)
+
+    def open_meta_index(self):
+        from metaindex import MetaIndex
+        try:
+            cache_dir = util.makedirs(self.get_cache_dir())
+            self.meta_index = MetaIndex(os.path.join(cache_dir, 'meta.db'))
+        except Exception:
+            logging.exception("Could not open the meta index, EXIF will be parsed every time")
+            self.meta_index = None
+            return
+
+        def _flush():
+            self.meta_index.flush()
+            return True
+        GObject.timeout_add(5000, _flush)
+
     def set_margins(self, margin):
         self.margin = margin
         def _f():
@@ -898,10 +1941,14 @@ class Ojo():
             (self.window.get_screen().get_width() - new_width) // 2,
             (self.window.get_screen().get_height() - new_height) // 2)
 
-    def go(self, direction, start_position=None):
+    def get_applicable_images(self):
         search = getattr(self, "search_text", "")
-        applicable = self.images if not search else \
+        return self.images if not search else \
             [f for f in self.images if os.path.basename(f).lower().find(search) >= 0]
+
+    def go(self, direction, start_position=None):
+        applicable = self.get_applicable_images()
+        self.navigation.register(direction)
         filename = None
         position = start_position - direction if start_position is not None else applicable.index(self.selected)
         position = (position + direction + len(applicable)) % len(applicable)
@@ -918,10 +1965,11 @@ class Ojo():
     def toggle_fullscreen(self, full=None, first_run=False):
         if full is None:
             full = not self.options['fullscreen']
-        self.options['fullscreen'] = full
-        self.save_options()
+        if full != self.options['fullscreen']:
+            self.options['fullscreen'] = full
+            self.save_options()
 
-        self.pix_cache[False] = {}
+        self.pix_cache[False].clear()
 
         if not first_run and self.shown:
             width = height = None
@@ -939,7 +1987,7 @@ class Ojo():
         self.last_automatic_resize = time.time()
 
         self.update_cursor()
-        self.js('toggle_fullscreen(' + ('true' if full else 'false') + ')')
+        self.js_call('toggle_fullscreen', full)
         self.js('setTimeout(scroll_to_selected, 100)')
 
     def update_margins(self):
@@ -978,7 +2026,7 @@ class Ojo():
         self.image.set_visible(self.mode == 'image')
         self.browser.set_visible(self.mode == 'folder')
         self.update_margins()
-        self.js("set_mode('%s')" % self.mode)
+        self.js_call('set_mode', self.mode)
 
         if self.mode == 'folder' and not self.manually_resized:
             self.resize_and_center(*self.get_recommended_size())
@@ -987,16 +2035,18 @@ class Ojo():
         images = filter(self.is_image, map(lambda f: os.path.join(folder, f), os.listdir(folder)))
         for img in images:
             cached = self.get_cached_thumbnail_path(img, True)
-            if os.path.isfile(cached) and os.path.split(cached)[0] == self.get_thumbs_cache_dir(120):
+            if os.path.isfile(cached) and self.thumb_cache.owns(cached):
                 try:
                     os.unlink(cached)
                 except IOError:
                     logging.exception("Could not delete %s" % cached)
+            if self.uses_thumb_packs():
+                self.thumb_packs.remove(img)
 
     def process_key(self, widget=None, event=None, key=None, skip_browser=False):
         key = key or Gdk.keyval_name(event.keyval)
         if key == 'Escape' and (self.mode == 'image' or skip_browser):
-            Gtk.main_quit()
+            self.quit()
         elif key in ("F11",) or (self.mode == 'image' and key in ('f', 'F')):
             self.toggle_fullscreen()
         elif key == 'F5':
@@ -1021,7 +2071,7 @@ class Ojo():
             elif key == 'Up' and event and (event.state & (Gdk.ModifierType.CONTROL_MASK | Gdk.ModifierType.MOD1_MASK)):
                 self.folder_parent()
             elif not skip_browser:
-                self.js("on_key('%s')" % key)
+                self.js_call('on_key', key)
             else:
                 if key == 'BackSpace':
                     self.folder_parent()
@@ -1033,6 +2083,10 @@ class Ojo():
             GObject.idle_add(lambda: self.go(1, 0))
         elif key == "End":
             GObject.idle_add(lambda: self.go(-1, len(self.images) - 1))
+        elif key in ("plus", "equal", "KP_Add"):
+            self.zoom_by(ZOOM_STEP)
+        elif key in ("minus", "KP_Subtract"):
+            self.zoom_by(1 / ZOOM_STEP)
         elif key in ("z", "Z"):
             self.set_zoom(not self.zoom)
             self.refresh_image()
@@ -1048,6 +2102,7 @@ class Ojo():
 
     def set_zoom(self, zoom, x_percent=None, y_percent=None):
         self.zoom = zoom
+        self.zoom_scale = 1.0   # zoom means 100% unless changed with zoom_to()
         if x_percent is None:
             x_percent = self.zoom_x_percent
         if y_percent is None:
@@ -1136,6 +2191,24 @@ class Ojo():
         self.mousedown_panning = False
         self.update_cursor()
 
+    def zoom_scrolled(self, widget, event):
+        """Ctrl + wheel zooms continuously around the mouse pointer"""
+        if self.mode != "image" or not event.state & Gdk.ModifierType.CONTROL_MASK:
+            return False
+        if event.direction == Gdk.ScrollDirection.UP:
+            factor = ZOOM_STEP
+        elif event.direction == Gdk.ScrollDirection.DOWN:
+            factor = 1 / ZOOM_STEP
+        elif event.direction == Gdk.ScrollDirection.SMOOTH:
+            factor = ZOOM_STEP ** -event.get_scroll_deltas()[2]
+        else:
+            return False
+        self.zoom_by(factor, *self.scroll_window.get_pointer())
+        return True
+
+    def pinch_zoom(self, gesture, scale):
+        self.zoom_to(self.pinch_start_scale * scale, *self.scroll_window.get_pointer())
+
     def scrolled(self, widget, event):
         if self.mode != "image" or self.zoom:
             return
@@ -1149,10 +2222,57 @@ class Ojo():
         direction = -1 if event.direction in (Gdk.ScrollDirection.UP, Gdk.ScrollDirection.LEFT) else 1
         self.wheel_timer = GObject.timeout_add(100, lambda: self.go(direction))
 
-    def pixbuf_from_data(self, data):
-        from gi.repository import Gio
-        input_str = Gio.MemoryInputStream.new_from_data(data, None)
-        return GdkPixbuf.Pixbuf.new_from_stream(input_str, None)
+    def create_pixbuf_loader(self, max_size=None):
+        loader = GdkPixbuf.PixbufLoader()
+        if max_size:
+            def _size_prepared(loader, w, h):
+                scale = min(1.0, float(max_size[0]) / w, float(max_size[1]) / h)
+                loader.set_size(max(1, int(w * scale)), max(1, int(h * scale)))
+            loader.connect('size-prepared', _size_prepared)
+        return loader
+
+    def pixbuf_from_data(self, data, max_size=None):
+        """Decodes image data. If max_size is given, the image is scaled down to fit in it while decoding."""
+        loader = self.create_pixbuf_loader(max_size)
+        loader.write(data)
+        loader.close()
+        return loader.get_pixbuf()
+
+    def load_pixbuf(self, path, decode_size=None, cancelled=None):
+        """
+        Decodes the image file at path, scaled down to fit in decode_size if given. When file_cache has the bytes
+        of the file, they are decoded from memory. If cancelled is given, the file is read in chunks, see
+        pixbuf_from_file.
+        """
+        data = self.file_cache.get(path)
+        if data is not None:
+            return self.pixbuf_from_data(data, decode_size)
+        if cancelled:
+            return self.pixbuf_from_file(path, decode_size, cancelled)
+        if decode_size:
+            return GdkPixbuf.Pixbuf.new_from_file_at_scale(path, decode_size[0], decode_size[1], True)
+        return GdkPixbuf.Pixbuf.new_from_file(path)
+
+    def pixbuf_from_file(self, filename, max_size=None, cancelled=None):
+        """
+        Like pixbuf_from_data, but feeds the file to the loader chunk by chunk and raises DecodeCancelled as soon
+        as cancelled() returns True, instead of finishing a decode nobody waits for anymore.
+        """
+        loader = self.create_pixbuf_loader(max_size)
+        with open(filename, 'rb') as f:
+            while True:
+                if cancelled and cancelled():
+                    try:
+                        loader.close()
+                    except GObject.GError:
+                        pass    # the loader complains about the truncated image
+                    raise DecodeCancelled(filename)
+                chunk = f.read(DECODE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                loader.write(chunk)
+        loader.close()
+        return loader.get_pixbuf()
 
     def pixbuf_to_b64(self, pixbuf):
         return pixbuf.save_to_bufferv('png', [], [])[1].encode("base64").replace('\n', '')
@@ -1162,26 +2282,124 @@ class Ojo():
         if not force_cache and os.path.splitext(filename)[1].lower() == '.gif':
             return filename
 
-        import hashlib
-        import re
-        # we append modification time to ensure we're not using outdated cached images
-        mtime = os.path.getmtime(filename)
-        hash = hashlib.md5(filename + str(mtime)).hexdigest()
-        return os.path.join(self.get_thumbs_cache_dir(120), re.sub('[\W_]+', '_', filename)[:80] + '_' + hash + ".jpg")
+        # modification time is part of the key to ensure we're not using outdated cached images
+        return self.thumb_cache.path_for(filename, self.get_file_stat(filename)[1])
+
+    def create_thumb_cache(self):
+        return ThumbnailCache(self.get_thumbs_cache_dir(120),
+                              max_bytes=self.options['thumbnail_cache_mb'] * 1024 * 1024,
+                              max_age=self.options['thumbnail_cache_days'] * 86400)
+
+    def create_thumb_packs(self):
+        from thumbpack import PackStore
+        return PackStore(os.path.join(self.get_cache_dir(), 'packs'),
+                         max_bytes=self.options['thumbnail_pack_mb'] * 1024 * 1024,
+                         max_age=self.options['thumbnail_cache_days'] * 86400)
+
+    def create_preview_cache(self):
+        return ThumbnailCache(os.path.join(self.get_cache_dir(), 'previews'),
+                              max_bytes=self.options['raw_preview_cache_mb'] * 1024 * 1024,
+                              max_age=self.options['thumbnail_cache_days'] * 86400)
+
+    def get_disk_caches(self):
+        return [('Thumbnail cache', self.thumb_cache), ('Thumbnail packs', self.thumb_packs),
+                ('RAW preview cache', self.preview_cache)]
+
+    def start_thumb_cache_gc(self):
+        def _flush():
+            for name, disk_cache in self.get_disk_caches():
+                disk_cache.flush()
+            return True
+        GObject.timeout_add(5000, _flush)
+
+        stale = [(name, c) for name, c in self.get_disk_caches() if c.needs_gc(THUMB_GC_INTERVAL)]
+        if not stale:
+            return
+
+        def _gc():
+            time.sleep(THUMB_GC_DELAY)
+            for name, disk_cache in stale:
+                try:
+                    removed, freed = disk_cache.prune()
+                    logging.info("%s GC: removed %d files, %.1f MB" % (name, removed, freed / 1024.0 / 1024))
+                except Exception:
+                    logging.exception("%s GC failed" % name)
+
+        gc_thread = threading.Thread(target=_gc)
+        gc_thread.daemon = True
+        gc_thread.start()
+
+    def run_cache_command(self):
+        for name, disk_cache in self.get_disk_caches():
+            if self.command_options.cache_prune:
+                removed, freed = disk_cache.prune()
+                print "%s: removed %d files, %.1f MB" % (name, removed, freed / 1024.0 / 1024)
+            stats = disk_cache.stats()
+            print "%s: %s" % (name, disk_cache.root)
+            print "  %d files, %.1f MB of %.1f MB allowed (%d indexed)" % (
+                stats['count'], stats['bytes'] / 1024.0 / 1024, stats['max_bytes'] / 1024.0 / 1024, stats['indexed'])
+            if stats['legacy_count']:
+                print "  %d files in the old unsharded layout, %.1f MB (removed by --cache-prune)" % (
+                    stats['legacy_count'], stats['legacy_bytes'] / 1024.0 / 1024)
+            print "  Files not used for %d days are removed" % stats['max_age_days']
+            print "  Last cleanup: %s" % (time.ctime(stats['last_gc']) if stats['last_gc'] else 'never')
+            disk_cache.close()
+
+    def run_prethumb(self, folder):
+        """Prepares the missing thumbnails of the images in folder (and subfolders, with -r) in worker processes"""
+        import multiprocessing
+        skip = None if self.options['show_hidden'] else lambda name: name.startswith('.')
+        images = filter(self.is_image, scanner.walk_files(folder, self.command_options.recursive, skip))
+
+        # the same tests and parameters the browser uses, see submit_thumb() and add_thumb()
+        todo = thumbnails.find_missing(
+            images, lambda img: self.get_packed_thumbnail(img) or os.path.exists(self.get_cached_thumbnail_path(img)),
+            self.is_thumbnail_failed)
+        print "%d images, %d thumbnails to prepare" % (len(images), len(todo))
+
+        workers = self.command_options.jobs or self.options['thumbnail_workers'] or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(workers, thumbnails.init_worker)
+        jobs = [(img, self.get_cached_thumbnail_path(img), 360, 120, None, self.get_thumbnail_mode(),
+                 self.get_shared_thumbnails_app()) for img in todo]
+        start = time.time()
+        prepared = failed = 0
+        try:
+            for i, (filename, thumb_path, error) in enumerate(pool.imap_unordered(prethumb_job, jobs)):
+                if not thumb_path:
+                    # the workers only have PIL - the same fallbacks as in the browser, see add_thumb()
+                    try:
+                        thumb_path = self.prepare_thumbnail(filename, 360, 120)
+                    except Exception:
+                        pass
+                if thumb_path:
+                    prepared += 1
+                    self.store_thumbnail(filename, thumb_path)
+                    print "[%d/%d] %s" % (i + 1, len(jobs), filename)
+                else:
+                    failed += 1
+                    self.save_thumbnail_failure(filename)
+                    print "[%d/%d] %s: failed (%s)" % (i + 1, len(jobs), filename, error)
+                sys.stdout.flush()
+            pool.close()
+        except KeyboardInterrupt:
+            pool.terminate()
+            print "Interrupted"
+        finally:
+            pool.join()
+            self.thumb_cache.close()
+            self.thumb_packs.close()
+        print "Prepared %d thumbnails in %.1f s, %d failed" % (prepared, time.time() - start, failed)
 
     def prepare_thumbnail(self, filename, width, height):
         cached = self.get_cached_thumbnail_path(filename)
+        if not os.path.exists(cached) and self.is_thumbnail_failed(filename):
+            raise IOError('Thumbnailing %s failed before' % filename)
 
         def use_pil():
-            pil = self.get_pil(filename, width, height, True)
-            format = {".gif": "GIF", ".png": "PNG", ".svg": "PNG"}.get(ext, 'JPEG')
-            for format in (format, 'JPEG', 'GIF', 'PNG'):
-                try:
-                    pil.save(cached, format)
-                    if os.path.getsize(cached):
-                        break
-                except Exception, e:
-                    logging.exception('Could not save thumbnail in format %s:' % format)
+            meta = self.get_meta_info(filename)
+            thumbnails.make_thumbnail(
+                filename, cached, width, height, (meta[4] or 1) if meta else None, self.get_thumbnail_mode(),
+                self.get_shared_thumbnails_app())
 
         def use_pixbuf():
             pixbuf = self.get_pixbuf(filename, True, False, 360, 120)
@@ -1204,26 +2422,49 @@ class Ojo():
             raise IOError('Could not create thumbnail')
         return cached
 
-    def get_pixbuf(self, filename, force=False, zoom=None, width=None, height=None):
+    def get_pixbuf(self, filename, force=False, zoom=None, width=None, height=None, cancelled=None):
+        """
+        Returns the pixbuf of filename at 100% or fit to width x height, from the cache or decoding it.
+        The same is never decoded twice at once: when another thread already decodes it, this waits for that one
+        (unless forced, even before looking at the cache) and takes its result if it has the right size. If cancelled
+        is given, the decode raises DecodeCancelled as soon as cancelled() returns True.
+        """
         if zoom is None:
             zoom = self.zoom
+        if zoom and self.is_tiled(filename):
+            zoom = False    # never decoded whole at 100%, see show_zoom_view()
 
         width = width or self.get_max_image_width()
         height = height or self.get_max_image_height()
 
-        while not force and self.current_preparing == (filename, zoom):
+        key = filename, zoom
+        if not force and self.decode_queue.is_running(key):
             logging.info("Waiting on cache")
-            self.preparing_event.wait()
-            self.preparing_event.clear()
-        if filename in self.pix_cache[zoom]:
-            cached = self.pix_cache[zoom][filename]
+            self.decode_queue.wait_for(key)
+        cached = self.pix_cache[zoom].get(filename)
+        if cached:
             if cached[1] == width:
                 logging.info("Cache hit: " + filename)
                 return cached[0]
 
+        owner = self.decode_queue.start(key)
+        if not owner:
+            # forced, or it started meanwhile - the result of the running decode will do if it has the size we need
+            self.decode_queue.wait_for(key)
+            cached = self.pix_cache[zoom].get(filename)
+            if cached and cached[1] == width:
+                return cached[0]
+            owner = self.decode_queue.start(key)
+        try:
+            return self.decode_pixbuf(filename, zoom, width, height, cancelled)
+        finally:
+            if owner:
+                self.decode_queue.finish(key)
+
+    def decode_pixbuf(self, filename, zoom, width, height, cancelled=None):
         full_meta = None
         orientation = None
-        if not filename in self.meta_cache:
+        if not filename in self.meta_cache and not self.load_indexed_meta(filename):
             full_meta = self.get_meta(filename)
         if filename in self.meta_cache:
             meta = self.meta_cache[filename]
@@ -1232,74 +2473,129 @@ class Ojo():
         else:
             image_width = image_height = None
 
-        enlarge_smaller = self.options['enlarge_smaller']
         if not image_width:
             format, image_width, image_height = GdkPixbuf.Pixbuf.get_file_info(filename)
 
+        rotated = orientation in (5, 6, 7, 8)
+        if rotated:
+            image_width, image_height = image_height, image_width
+
+        final_size = None if zoom else self.get_fit_size(image_width, image_height, width, height)
+
+        master = self.get_resize_master(filename) if final_size else None
+        if master and master.get_width() >= final_size[0] and master.get_height() >= final_size[1]:
+            # e.g. after a resize - a good rescale of what was shown before is much cheaper than decoding again
+            pixbuf = master if (master.get_width(), master.get_height()) == final_size else \
+                master.scale_simple(final_size[0], final_size[1], GdkPixbuf.InterpType.HYPER)
+            self.pix_cache[zoom][filename] = pixbuf, width
+            return pixbuf
+
+        # When scaling down anyway, decode directly at the reduced size (e.g. JPEGs get DCT-scaled while decoding).
+        # decode_size is in the orientation the image is stored in, i.e. before auto-rotation.
+        decode_size = None
+        if final_size and final_size[0] < image_width:
+            decode_size = (final_size[1], final_size[0]) if rotated else final_size
+
         pixbuf = None
+        raw = thumbnails.is_raw(filename)
 
-        try:
-            pixbuf = GdkPixbuf.Pixbuf.new_from_file(filename)
-            logging.debug("Loaded directly")
-        except GObject.GError, e:
-            pass # below we'll use another method
+        if raw:
+            # trying to decode RAW files directly mostly fails, and slowly - go for the embedded previews first
+            pixbuf = self.get_raw_pixbuf(filename, full_meta, decode_size)
 
         if not pixbuf:
+            try:
+                pixbuf = self.load_pixbuf(filename, decode_size, cancelled)
+                logging.debug("Loaded directly")
+            except (GObject.GError, IOError), e:
+                pass # below we'll use another method
+
+        if not pixbuf and cancelled and cancelled():
+            raise DecodeCancelled(filename)
+
+        if not pixbuf and not raw:
             try:
                 if not full_meta:
                     full_meta = self.get_meta(filename)
                 preview = full_meta.previews[-1].data
-                pixbuf = self.pixbuf_from_data(preview)
+                pixbuf = self.pixbuf_from_data(preview, decode_size)
                 logging.debug("Loaded from preview")
             except Exception, e:
                 pass # below we'll use another method
 
         if not pixbuf:
-            pixbuf = self.pil_to_pixbuf(self.get_pil(filename))
+            pil_image = self.get_pil(filename)
+            if decode_size:
+                pil_image.draft(pil_image.mode, decode_size)
+            pixbuf = self.pil_to_pixbuf(pil_image)
             logging.debug("Loaded with PIL")
 
         pixbuf = self.auto_rotate_pixbuf(orientation, pixbuf)
-        if orientation in (5, 6, 7, 8):
-            # needs rotation
-            image_width, image_height = image_height, image_width
-
-        if not zoom:
-            target_width = image_width if zoom else (width if enlarge_smaller else min(width, image_width))
-            target_height = image_height if zoom else (height if enlarge_smaller else min(height, image_height))
 
-            if float(target_width) / target_height < float(image_width) / image_height:
-                pixbuf = pixbuf.scale_simple(target_width, int(float(target_width) * image_height / image_width), GdkPixbuf.InterpType.BILINEAR)
-            else:
-                pixbuf = pixbuf.scale_simple(int(float(target_height) * image_width / image_height), target_height, GdkPixbuf.InterpType.BILINEAR)
+        if final_size and (pixbuf.get_width(), pixbuf.get_height()) != final_size:
+            pixbuf = pixbuf.scale_simple(final_size[0], final_size[1], GdkPixbuf.InterpType.BILINEAR)
 
         self.pix_cache[zoom][filename] = pixbuf, width
 
         return pixbuf
 
-    def get_pil(self, filename, width=None, height=None):
-        from PIL import Image
+    def get_raw_pixbuf(self, filename, full_meta=None, decode_size=None):
+        """
+        Decodes a RAW file from its embedded previews, or returns None. The largest preview is kept on disk, so it
+        never needs to be extracted again; until it is, the smallest preview covering decode_size is used.
+        """
+        mtime = self.get_file_stat(filename)[1]
+        cached = self.preview_cache.path_for(filename, mtime)
+        if os.path.exists(cached):
+            try:
+                pixbuf = self.load_pixbuf(cached, decode_size)
+                self.preview_cache.record_use(cached, filename, mtime)
+                logging.debug("Loaded from cached preview")
+                return pixbuf
+            except GObject.GError:
+                logging.warning("Could not load cached preview %s, extracting it again" % cached)
 
         try:
-            pil_image = Image.open(filename)
-        except IOError:
-            import cStringIO
-            full_meta = self.get_meta(filename)
-            pil_image = Image.open(cStringIO.StringIO(full_meta.previews[-1].data))
+            meta = full_meta or self.get_meta(filename)
+            if not meta or not meta.previews:
+                return None
+            largest = max(meta.previews, key=lambda p: p.dimensions[0] * p.dimensions[1])
+            if largest.mime_type == 'image/jpeg':
+                self.save_raw_preview(largest.data, cached)
+                self.preview_cache.record_use(cached, filename, mtime)
+            # decode_size is already in stored orientation, so no orientation is passed
+            preview = thumbnails.select_preview(meta, decode_size[0], decode_size[1], fallback_to_largest=True) \
+                if decode_size else largest
+            pixbuf = self.pixbuf_from_data(preview.data, decode_size)
+            logging.debug("Loaded from preview")
+            return pixbuf
+        except Exception:
+            logging.exception("Could not load a preview of %s" % filename)
+            return None
 
-        if width is not None:
-            if not filename in self.meta_cache:
-                self.get_meta(filename)
-            meta = self.meta_cache.get(filename, None)
+    def save_raw_preview(self, data, cached):
+        try:
+            util.write_atomically(cached, lambda f: f.write(data))
+        except Exception:
+            logging.exception("Could not save preview in %s" % cached)
 
-            pil_image.thumbnail((max(width, height), max(width, height)), Image.ANTIALIAS)
+    def get_fit_size(self, image_width, image_height, width, height):
+        """Size at which an image of the given (oriented) size is shown fit in width x height"""
+        enlarge_smaller = self.options['enlarge_smaller']
+        target_width = width if enlarge_smaller else min(width, image_width)
+        target_height = height if enlarge_smaller else min(height, image_height)
 
-            try:
-                pil_image = self.auto_rotate(meta[4] if meta else None, pil_image)
-            except Exception:
-                logging.exception('Auto-rotation failed for %s' % filename)
+        if float(target_width) / target_height < float(image_width) / image_height:
+            return target_width, int(float(target_width) * image_height / image_width)
+        else:
+            return int(float(target_height) * image_width / image_height), target_height
+
+    def get_pil(self, filename, width=None, height=None):
+        pil_image = thumbnails.open_image(filename)
 
-            if pil_image.size[0] > width or pil_image.size[1] > height:
-                pil_image.thumbnail((width, height), Image.ANTIALIAS)
+        if width is not None:
+            meta = self.get_meta_info(filename)
+            pil_image = thumbnails.fit_pil(pil_image, meta[4] if meta else None, width, height)
 
         return pil_image
 
@@ -1331,40 +2627,6 @@ class Ojo():
     def needs_rotation(self, meta):
         return 'Exif.Image.Orientation' in meta.keys() and meta['Exif.Image.Orientation'].value in (5, 6, 7, 8)
 
-    def auto_rotate(self, orientation, im):
-        from PIL import Image
-        # We rotate regarding to the EXIF orientation information
-        if orientation is None:
-            result = im
-        elif orientation == 1:
-            # Nothing
-            result = im
-        elif orientation == 2:
-            # Vertical Mirror
-            result = im.transpose(Image.FLIP_LEFT_RIGHT)
-        elif orientation == 3:
-            # Rotation 180°
-            result = im.transpose(Image.ROTATE_180)
-        elif orientation == 4:
-            # Horizontal Mirror
-            result = im.transpose(Image.FLIP_TOP_BOTTOM)
-        elif orientation == 5:
-            # Horizontal Mirror + Rotation 270°
-            result = im.transpose(Image.FLIP_TOP_BOTTOM).transpose(Image.ROTATE_270)
-        elif orientation == 6:
-            # Rotation 270°
-            result = im.transpose(Image.ROTATE_270)
-        elif orientation == 7:
-            # Vertical Mirror + Rotation 270°
-            result = im.transpose(Image.FLIP_LEFT_RIGHT).transpose(Image.ROTATE_270)
-        elif orientation == 8:
-            # Rotation 90°
-            result = im.transpose(Image.ROTATE_90)
-        else:
-            result = im
-
-        return result
-
     def auto_rotate_pixbuf(self, orientation, im):
         # We rotate regarding to the EXIF orientation information
         if orientation is None:
@@ -1377,7 +2639,7 @@ class Ojo():
             result = im.flip(True)
         elif orientation == 3:
             # Rotation 180°
-            result = im.rotate_simplae(180)
+            result = im.rotate_simple(180)
         elif orientation == 4:
             # Horizontal Mirror
             result = im.flip(False)
@@ -0,0 +1,50 @@
+import time
+
+
+class NavigationTracker(object):
+    """
+    Tracks the direction and speed with which the user moves between images, so we can prefetch
+    further ahead in the direction of travel while the user is holding a key or spinning the wheel.
+    """
+
+    def __init__(self, ahead=4, behind=1, max_ahead=12, idle_time=1.5, history_time=2.0):
+        self.ahead = ahead
+        self.behind = behind
+        self.max_ahead = max_ahead
+        self.idle_time = idle_time
+        self.history_time = history_time
+        self.moves = []     # (time, direction) of recent moves
+
+    def register(self, direction, now=None):
+        now = now if now is not None else time.time()
+        self.moves = [m for m in self.moves if now - m[0] <= self.history_time]
+        self.moves.append((now, 1 if direction >= 0 else -1))
+
+    def get_direction(self):
+        return self.moves[-1][1] if self.moves else 1
+
+    def get_speed(self, now=None):
+        """Moves per second in the recent history, counting only moves in the current direction"""
+        now = now if now is not None else time.time()
+        direction = self.get_direction()
+        recent = [m for m in self.moves if now - m[0] <= self.history_time and m[1] == direction]
+        return len(recent) / float(self.history_time)
+
+    def is_idle(self, now=None):
+        now = now if now is not None else time.time()
+        return not self.moves or now - self.moves[-1][0] > self.idle_time
+
+    def get_window(self, now=None):
+        """Returns (ahead, behind) - how many images to prefetch in and against the direction of travel"""
+        if self.is_idle(now):
+            return 1, 1
+        return min(self.max_ahead, self.ahead + int(self.get_speed(now))), self.behind
+
+    def get_offsets(self, now=None):
+        """Position offsets to prefetch, relative to the current image, most important first"""
+        ahead, behind = self.get_window(now)
+        direction = self.get_direction()
+        offsets = [direction] + ([-direction] if behind else [])
+        offsets += [direction * i for i in range(2, ahead + 1)]
+        offsets += [-direction * i for i in range(2, behind + 1)]
+        return offsets
@@ -0,0 +1,123 @@
+import os
+import stat
+
+try:
+    from scandir import scandir     # the backport of os.scandir, if installed
+except ImportError:
+    scandir = None
+
+
+class FolderEntry(object):
+    __slots__ = ('name', 'path', 'is_dir', 'is_file', 'size', 'mtime')
+
+    def __init__(self, name, path, is_dir, is_file, size, mtime):
+        self.name = name
+        self.path = path
+        self.is_dir = is_dir
+        self.is_file = is_file
+        self.size = size
+        self.mtime = mtime
+
+
+class FolderModel(object):
+    """
+    In-memory listing of a folder, built with a single pass over its entries. Image listing, subfolder listing,
+    sorting and thumbnail cache validation all read file types, sizes and mtimes from here instead of stat-ing.
+    """
+
+    def __init__(self, path, entries):
+        self.path = path
+        self.entries = dict((e.name, e) for e in entries)
+
+    def get(self, path):
+        """The entry for a full path, or None if it is not (directly) in this folder"""
+        folder, name = os.path.split(path)
+        return self.entries.get(name) if folder == self.path else None
+
+    def files(self):
+        return [e.path for e in self.entries.values() if e.is_file]
+
+    def folders(self):
+        return sorted(e.path for e in self.entries.values() if e.is_dir)
+
+    def update(self, path):
+        """Re-reads a single entry (e.g. after a filesystem notification), returns it or None if it is gone"""
+        name = os.path.basename(path)
+        entry = stat_entry(self.path, name)
+        if entry:
+            self.entries[name] = entry
+        else:
+            self.entries.pop(name, None)
+        return entry
+
+    def remove(self, path):
+        return self.entries.pop(os.path.basename(path), None)
+
+    def apply_changes(self, paths, images, is_image):
+        """
+        Re-reads the changed paths and sorts them out against the images currently listed: returns the lists of
+        added, removed and changed images, and whether any subfolder came or went. is_image(entry) tells the
+        entries to list as images.
+        """
+        added, removed, changed = [], [], []
+        listed = set(images)
+        folders_changed = False
+        for path in sorted(paths):
+            old_entry = self.get(path)
+            entry = self.update(path)
+            if (old_entry and old_entry.is_dir) or (entry and entry.is_dir):
+                folders_changed = True
+            shown = entry is not None and is_image(entry)
+            if path in listed:
+                (changed if shown else removed).append(path)
+            elif shown:
+                added.append(path)
+        return added, removed, changed, folders_changed
+
+
+def stat_entry(folder, name):
+    path = os.path.join(folder, name)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None     # e.g. a broken symlink, or deleted meanwhile
+    return FolderEntry(name, path, stat.S_ISDIR(st.st_mode), stat.S_ISREG(st.st_mode), st.st_size, st.st_mtime)
+
+
+def scan_folder(folder):
+    entries = []
+    if scandir:
+        for e in scandir(folder):
+            if e.is_dir():
+                # d_type is enough for folders, no need to stat them
+                entries.append(FolderEntry(e.name, e.path, True, False, 0, 0))
+            else:
+                entry = stat_entry(folder, e.name)
+                if entry:
+                    entries.append(entry)
+    else:
+        for name in os.listdir(folder):
+            entry = stat_entry(folder, name)
+            if entry:
+                entries.append(entry)
+    return FolderModel(folder, entries)
+
+
+def walk_files(folder, recursive=False, skip=None):
+    """
+    The files in folder - and with recursive, in all its subfolders - folder by folder, sorted by name.
+    Files and subfolders for which skip(name) is true are left out.
+    """
+    paths = []
+    for root, dirs, files in os.walk(folder):
+        if not recursive:
+            del dirs[:]
+        dirs[:] = sorted(d for d in dirs if not skip or not skip(d))
+        paths += [os.path.join(root, f) for f in sorted(files) if not skip or not skip(f)]
+    return paths
+
+
+def list_subfolders(folder):
+    if scandir:
+        return sorted(e.path for e in scandir(folder) if e.is_dir())
+    return sorted(os.path.join(folder, f) for f in os.listdir(folder) if os.path.isdir(os.path.join(folder, f)))
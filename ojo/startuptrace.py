@@ -0,0 +1,33 @@
+#  Wall-clock timestamps of the startup phases, printed with --startup-trace.
+#  Imported first thing, so that the time it takes to import everything else is part of the trace.
+
+import sys
+import time
+
+START = time.time()
+
+marks = []
+enabled = False
+
+
+def mark(phase):
+    """Records that a startup phase just ended. Phases are only recorded once."""
+    if any(p == phase for p, t in marks):
+        return
+    marks.append((phase, time.time()))
+    if enabled:
+        report(len(marks) - 1)
+
+
+def enable():
+    """Prints the phases recorded so far, and then every following one as it ends"""
+    global enabled
+    enabled = True
+    for i in range(len(marks)):
+        report(i)
+
+
+def report(i):
+    phase, t = marks[i]
+    since_previous = t - (marks[i - 1][1] if i else START)
+    sys.stderr.write("startup: %8.1f ms  (+%7.1f ms)  %s\n" % ((t - START) * 1000, since_previous * 1000, phase))
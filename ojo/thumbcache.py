@@ -0,0 +1,219 @@
+import os
+import re
+import threading
+import time
+
+# Thumbnails are spread over 256 subfolders by the first two hex digits of their name
+SHARD_CHARS = 2
+
+# Files in the cache folder that are not thumbnails
+INDEX_NAME = 'thumbs.db'
+LAST_GC_NAME = 'last_gc'
+
+# Older versions of Ojo kept their thumbnails right in the root, as <path with _ for non-word chars>_<md5>.jpg
+LEGACY_NAME = re.compile(r'^.*_[0-9a-f]{32}\.jpg$')
+
+
+class ThumbnailCache(object):
+    """
+    Ojo's own thumbnail cache: <root>/<shard>/<md5 of path + mtime>.jpg, bounded in size and age.
+    Also used for the previews extracted from RAW files.
+    A small SQLite index remembers the source and last use of every thumbnail, so that prune() can evict
+    orphaned (source edited, moved or deleted) and least recently used thumbnails.
+    The index is opened lazily and writes to it are batched - computing a thumbnail path never touches it.
+    """
+
+    def __init__(self, root, max_bytes, max_age, batch_size=100):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.batch_size = batch_size
+        self.lock = threading.RLock()
+        self.pending = {}
+        self.db = None
+        self.created_shards = set()
+
+    def path_for(self, source, mtime):
+        """The thumbnail path for the given source path and mtime, creating its shard folder if needed"""
+        import hashlib
+        name = hashlib.md5(source + str(mtime)).hexdigest() + '.jpg'
+        shard = os.path.join(self.root, name[:SHARD_CHARS])
+        if shard not in self.created_shards:
+            try:
+                os.makedirs(shard)
+            except OSError:
+                if not os.path.isdir(shard):    # else created meanwhile by another thread
+                    raise
+            self.created_shards.add(shard)
+        return os.path.join(shard, name)
+
+    def owns(self, path):
+        folder, name = os.path.split(path)
+        return os.path.dirname(folder) == self.root and name.startswith(os.path.basename(folder))
+
+    def get_db(self):
+        with self.lock:
+            if self.db is None:
+                import sqlite3
+                if not os.path.isdir(self.root):
+                    os.makedirs(self.root)
+                self.db = sqlite3.connect(os.path.join(self.root, INDEX_NAME), check_same_thread=False)
+                self.db.text_factory = str     # paths are byte strings
+                self.db.execute("CREATE TABLE IF NOT EXISTS thumbs ("
+                                "name TEXT PRIMARY KEY, source TEXT, source_mtime REAL, size INTEGER, "
+                                "last_used REAL)")
+                self.db.commit()
+            return self.db
+
+    def record_use(self, path, source, mtime, now=None):
+        """Records that the thumbnail at path (of source with the given mtime) was created or shown"""
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        with self.lock:
+            self.pending[os.path.basename(path)] = (source, mtime, size, now or time.time())
+            if len(self.pending) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            db = self.get_db()
+            db.executemany(
+                "INSERT OR REPLACE INTO thumbs (name, source, source_mtime, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                [(name,) + row for name, row in self.pending.items()])
+            db.commit()
+            self.pending = {}
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            if self.db:
+                self.db.close()
+                self.db = None
+
+    def list_files(self):
+        """
+        Returns (thumbnails, legacy): [(name, path, size, mtime)] of the files in the shard folders, and
+        the paths of thumbnails left directly in the root by older versions of Ojo.
+        """
+        thumbs = []
+        legacy = []
+        if not os.path.isdir(self.root):
+            return thumbs, legacy
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if len(name) == SHARD_CHARS and os.path.isdir(path):
+                for thumb in os.listdir(path):
+                    if thumb.endswith('.tmp'):
+                        continue    # still being written
+                    try:
+                        st = os.stat(os.path.join(path, thumb))
+                    except OSError:
+                        continue
+                    thumbs.append((thumb, os.path.join(path, thumb), st.st_size, st.st_mtime))
+            elif LEGACY_NAME.match(name) and os.path.isfile(path):
+                legacy.append(path)
+        return thumbs, legacy
+
+    def stats(self):
+        thumbs, legacy = self.list_files()
+        with self.lock:
+            self.flush()
+            indexed = self.get_db().execute("SELECT COUNT(*) FROM thumbs").fetchone()[0]
+        return {
+            'count': len(thumbs),
+            'bytes': sum(t[2] for t in thumbs),
+            'indexed': indexed,
+            'legacy_count': len(legacy),
+            'legacy_bytes': sum(os.path.getsize(p) for p in legacy if os.path.exists(p)),
+            'max_bytes': self.max_bytes,
+            'max_age_days': self.max_age / 86400.0,
+            'last_gc': self.get_last_gc(),
+        }
+
+    def prune(self, now=None):
+        """
+        Deletes legacy, orphaned, expired and then least recently used thumbnails until the cache fits
+        max_bytes. Returns (files removed, bytes freed).
+        """
+        now = now or time.time()
+        thumbs, legacy = self.list_files()
+        with self.lock:
+            self.flush()
+            index = dict((row[0], row[1:]) for row in self.get_db().execute(
+                "SELECT name, source, source_mtime, last_used FROM thumbs"))
+
+        removed = []
+        freed = [0]
+
+        def _remove(name, path, size):
+            try:
+                os.unlink(path)
+            except OSError:
+                return
+            removed.append(name)
+            freed[0] += size
+
+        for path in legacy:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                continue
+            _remove(None, path, size)
+
+        kept = []
+        for name, path, size, mtime in thumbs:
+            if name in index:
+                source, source_mtime, last_used = index[name]
+                if not is_current(source, source_mtime):
+                    _remove(name, path, size)
+                    continue
+            else:
+                last_used = mtime   # not indexed (e.g. the index was deleted) - judge by age alone
+            if now - last_used > self.max_age:
+                _remove(name, path, size)
+                continue
+            kept.append((last_used, name, path, size))
+
+        total = sum(k[3] for k in kept)
+        if total > self.max_bytes:
+            kept.sort()
+            for last_used, name, path, size in kept:
+                if total <= self.max_bytes:
+                    break
+                _remove(name, path, size)
+                total -= size
+
+        existing = set(t[0] for t in thumbs)
+        stale = [n for n in removed if n] + [n for n in index if n not in existing]
+        with self.lock:
+            db = self.get_db()
+            db.executemany("DELETE FROM thumbs WHERE name = ?", [(n,) for n in stale])
+            db.commit()
+        self.set_last_gc(now)
+        return len(removed), freed[0]
+
+    def get_last_gc(self):
+        try:
+            return os.path.getmtime(os.path.join(self.root, LAST_GC_NAME))
+        except OSError:
+            return None
+
+    def set_last_gc(self, now):
+        stamp = os.path.join(self.root, LAST_GC_NAME)
+        open(stamp, 'w').close()
+        os.utime(stamp, (now, now))
+
+    def needs_gc(self, interval, now=None):
+        last = self.get_last_gc()
+        return last is None or (now or time.time()) - last > interval
+
+
+def is_current(source, source_mtime):
+    try:
+        return os.path.getmtime(source) == source_mtime
+    except OSError:
+        return False
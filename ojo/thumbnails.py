@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# Thumbnail generation, used both in-process and from the thumbnail worker processes.
+# Only PIL and pyexiv2 are used here - no GTK, so this is safe to run in forked workers.
+
+import os
+import logging
+import xdgthumbs
+
+# RAW formats, as per https://en.wikipedia.org/wiki/Raw_image_format#Annotated_list_of_file_extensions,
+# we rely on pyexiv2 previews for these:
+RAW_EXTENSIONS = {"3fr", "ari", "arw", "srf", "sr2", "bay", "crw", "cr2", "cap", "iiq",
+                  "eip", "dcs", "dcr", "drf", "k25", "kdc", "dng", "erf", "fff", "mef", "mos", "mrw",
+                  "nef", "nrw", "orf", "pef", "ptx", "pxn", "r3d", "raf", "raw", "rw2", "rwl",
+                  "rwz", "srw", "x3f"}
+
+
+def is_raw(filename):
+    return os.path.splitext(filename)[1].lower()[1:] in RAW_EXTENSIONS
+
+
+def read_meta(filename):
+    from pyexiv2 import ImageMetadata
+    meta = ImageMetadata(filename)
+    meta.read()
+    return meta
+
+
+def meta_orientation(meta):
+    return meta['Exif.Image.Orientation'].value if 'Exif.Image.Orientation' in meta else None
+
+
+def get_orientation(filename):
+    try:
+        return meta_orientation(read_meta(filename))
+    except Exception:
+        return None
+
+
+def covers(size, width, height):
+    """True if an image of the given size can be fit in width x height without upscaling"""
+    w, h = size
+    return bool(w and h) and min(float(width) / w, float(height) / h) <= 1
+
+
+def select_preview(meta, width, height, orientation=None, fallback_to_largest=False):
+    """
+    Returns the smallest embedded preview that still covers width x height once oriented, or None.
+    Previews with an aspect ratio different from the image's are skipped - EXIF thumbnails are often letterboxed.
+    """
+    image_w, image_h = meta.dimensions
+    candidates = []
+    for preview in sorted(meta.previews, key=lambda p: p.dimensions[0] * p.dimensions[1]):
+        w, h = preview.dimensions
+        if not w or not h:
+            continue
+        if image_w and image_h and abs(float(w) / h - float(image_w) / image_h) > 0.02 * image_w / image_h:
+            continue
+        candidates.append(preview)
+        if covers((h, w) if orientation in (5, 6, 7, 8) else (w, h), width, height):
+            return preview
+    return candidates[-1] if candidates and fallback_to_largest else None
+
+
+def preview_image(preview):
+    import cStringIO
+    from PIL import Image
+    return Image.open(cStringIO.StringIO(preview.data))
+
+
+def open_image(filename):
+    from PIL import Image
+    try:
+        return Image.open(filename)
+    except IOError:
+        # RAW and other formats PIL can't read - use the largest embedded preview
+        return preview_image(read_meta(filename).previews[-1])
+
+
+def auto_rotate(orientation, im):
+    from PIL import Image
+    # We rotate regarding to the EXIF orientation information
+    if orientation is None:
+        result = im
+    elif orientation == 1:
+        # Nothing
+        result = im
+    elif orientation == 2:
+        # Vertical Mirror
+        result = im.transpose(Image.FLIP_LEFT_RIGHT)
+    elif orientation == 3:
+        # Rotation 180°
+        result = im.transpose(Image.ROTATE_180)
+    elif orientation == 4:
+        # Horizontal Mirror
+        result = im.transpose(Image.FLIP_TOP_BOTTOM)
+    elif orientation == 5:
+        # Horizontal Mirror + Rotation 270°
+        result = im.transpose(Image.FLIP_TOP_BOTTOM).transpose(Image.ROTATE_270)
+    elif orientation == 6:
+        # Rotation 270°
+        result = im.transpose(Image.ROTATE_270)
+    elif orientation == 7:
+        # Vertical Mirror + Rotation 270°
+        result = im.transpose(Image.FLIP_LEFT_RIGHT).transpose(Image.ROTATE_270)
+    elif orientation == 8:
+        # Rotation 90°
+        result = im.transpose(Image.ROTATE_90)
+    else:
+        result = im
+
+    return result
+
+
+def fit_pil(pil_image, orientation, width, height):
+    """Scales down to fit in width x height, applying the EXIF orientation on the way"""
+    from PIL import Image
+    size = max(width, height)
+    pil_image.draft(pil_image.mode, (size, size))    # lets JPEGs decode at 1/2, 1/4 or 1/8 scale
+    pil_image.thumbnail((size, size), Image.ANTIALIAS)
+
+    try:
+        pil_image = auto_rotate(orientation, pil_image)
+    except Exception:
+        logging.exception('Auto-rotation failed')
+
+    if pil_image.size[0] > width or pil_image.size[1] > height:
+        pil_image.thumbnail((width, height), Image.ANTIALIAS)
+    return pil_image
+
+
+def save_thumbnail(pil_image, cached, ext):
+    format = {".gif": "GIF", ".png": "PNG", ".svg": "PNG"}.get(ext, 'JPEG')
+    for format in (format, 'JPEG', 'GIF', 'PNG'):
+        try:
+            pil_image.save(cached, format)
+            if os.path.getsize(cached):
+                break
+        except Exception:
+            logging.exception('Could not save thumbnail in format %s:' % format)
+
+
+def make_thumbnail(filename, cached, width, height, orientation=None, mode='full', shared_app=None):
+    """
+    Saves a thumbnail of filename in cached. Unless mode is 'full', a big enough embedded preview is used
+    instead of decoding the whole image.
+    RAW files are always thumbnailed from the smallest preview that covers the size - that is all there is to them.
+    If shared_app is given, a 'large' thumbnail is also written to the shared freedesktop.org thumbnail cache.
+    """
+    from PIL import Image
+    pil_image = None
+    from_preview = False
+    raw = is_raw(filename)
+    if mode != 'full' or raw:
+        try:
+            meta = read_meta(filename)
+            if orientation is None:
+                orientation = meta_orientation(meta)
+            preview = select_preview(meta, width, height, orientation, fallback_to_largest=raw)
+            if preview:
+                pil_image = preview_image(preview)
+                from_preview = True
+        except Exception:
+            logging.debug("No usable embedded preview in %s" % filename)
+
+    if pil_image is None:
+        if orientation is None:
+            orientation = get_orientation(filename)
+        pil_image = open_image(filename)
+
+    original_size = pil_image.size[::-1] if orientation in (5, 6, 7, 8) else pil_image.size
+    size = max(width, height)
+    pil_image = fit_pil(pil_image, orientation, size, size)
+
+    if shared_app and (max(pil_image.size) >= 256 or not from_preview):
+        try:
+            large = pil_image.copy()
+            large.thumbnail((256, 256), Image.ANTIALIAS)
+            xdgthumbs.save(large, filename, os.path.getmtime(filename), 'large',
+                           None if from_preview else original_size)
+        except Exception:
+            logging.exception("Could not save shared thumbnail for %s" % filename)
+
+    pil_image = fit_pil(pil_image, None, width, height)
+    save_thumbnail(pil_image, cached, os.path.splitext(filename)[1].lower())
+    if not os.path.isfile(cached) or not os.path.getsize(cached):
+        raise IOError('Could not create thumbnail')
+    return cached
+
+
+def thumbnail_job(filename, cached, width, height, orientation=None, mode='full', shared_app=None):
+    """Entry point for the worker processes: never raises, returns (filename, cached or None, error or None)"""
+    try:
+        return filename, make_thumbnail(filename, cached, width, height, orientation, mode, shared_app), None
+    except Exception, e:
+        return filename, None, str(e)
+
+
+def find_missing(images, has_thumbnail, is_failed):
+    """The images that still need a thumbnail: the ones without one that did not fail before, in order"""
+    return [img for img in images if not has_thumbnail(img) and not is_failed(img)]
+
+
+def init_worker():
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
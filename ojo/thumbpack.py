@@ -0,0 +1,382 @@
+import itertools
+import json
+import os
+import threading
+import time
+
+# A pack is compacted once this share of its bytes belongs to replaced, removed or outdated thumbnails
+COMPACT_RATIO = 0.5
+
+LAST_GC_NAME = 'last_gc'
+
+# makes pack names unique within the process, the time and pid make them unique across processes
+pack_counter = itertools.count()
+
+
+def dumps(value):
+    # paths are byte strings in any encoding, latin-1 maps each byte to a character and back
+    return json.dumps(value, encoding='latin-1') + '\n'
+
+
+class Packed(object):
+    """
+    A thumbnail read from a pack - what the viewer gets instead of a thumbnail path. path is set for one read from a
+    thumbnail file that is still to be packed.
+    """
+
+    def __init__(self, data, path=None):
+        self.data = data
+        self.path = path
+
+    def get_mime_type(self):
+        if self.data.startswith('\x89PNG'):
+            return 'image/png'
+        elif self.data.startswith('GIF8'):
+            return 'image/gif'
+        return 'image/jpeg'
+
+    def to_data_uri(self):
+        return 'data:%s;base64,%s' % (self.get_mime_type(), self.data.encode('base64').replace('\n', ''))
+
+
+class ThumbPack(object):
+    """
+    The thumbnails of the images in one folder, appended one after the other to a single pack file, and read back
+    through an mmap of it. The index is a file of JSON lines: a header naming the folder and the pack file, then
+    [name, mtime, size, offset, length] per thumbnail, the last line for a name winning (length None removes it).
+    Compaction writes a new pack and then switches to it by replacing the index - appends and compactions from
+    several processes are serialized with a lock on the index file.
+    """
+
+    def __init__(self, root, folder):
+        import hashlib
+        self.root = root
+        self.folder = folder
+        self.index_path = os.path.join(root, hashlib.md5(folder).hexdigest() + '.idx')
+        self.lock = threading.RLock()
+        self.map = None
+        self.load()
+
+    def load(self):
+        with self.lock:
+            self.close()
+            self.entries = {}   # name -> (mtime, size, offset, length)
+            self.dead_bytes = 0
+            self.pack_name = None
+            self.index_inode = None
+            try:
+                with open(self.index_path) as f:
+                    self.index_inode = os.fstat(f.fileno()).st_ino
+                    self.pack_name = json.loads(f.readline())['pack'].encode('latin-1')
+                    for line in f:
+                        try:
+                            name, mtime, size, offset, length = json.loads(line)
+                        except ValueError:
+                            continue    # torn by a crash while appending
+                        name = name.encode('latin-1')
+                        if name in self.entries:
+                            self.dead_bytes += self.entries.pop(name)[3]
+                        if length is not None:
+                            self.entries[name] = mtime, size, offset, length
+            except (IOError, ValueError, KeyError):
+                return
+            # thumbnails are appended before their index line, but a pack can still be cut short by a full disk
+            pack_size = self.get_pack_size()
+            for name, entry in self.entries.items():
+                if entry[2] + entry[3] > pack_size:
+                    del self.entries[name]
+
+    def get_pack_path(self):
+        return os.path.join(self.root, self.pack_name) if self.pack_name else None
+
+    def get_pack_size(self):
+        try:
+            return os.path.getsize(self.get_pack_path())
+        except (OSError, TypeError):
+            return 0
+
+    def get(self, name, mtime, size):
+        """The thumbnail data of name, if there is one for the given mtime and size of the image, else None"""
+        with self.lock:
+            entry = self.entries.get(name)
+            if not entry or entry[0] != mtime or entry[1] != size:
+                return None
+            offset, length = entry[2], entry[3]
+            if self.map is None or offset + length > len(self.map):
+                if not self.remap() or offset + length > len(self.map):
+                    return None
+            return self.map[offset:offset + length]
+
+    def remap(self):
+        import mmap
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        try:
+            with open(self.get_pack_path(), 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return True
+        except (IOError, TypeError, ValueError, EnvironmentError):
+            self.load()     # e.g. compacted meanwhile by another process
+            return False
+
+    def locked_index(self):
+        """Opens the index for appending and locks it against other processes, reloading if it was replaced"""
+        import fcntl
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        f = open(self.index_path, 'a')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        if os.fstat(f.fileno()).st_ino != self.index_inode or not self.pack_name:
+            self.load()
+            if not self.pack_name:
+                f.truncate(0)   # new, or unreadable anyway
+                self.pack_name = self.new_pack_name()
+                f.write(dumps({'folder': self.folder, 'pack': self.pack_name}))
+                f.flush()
+            self.index_inode = os.fstat(f.fileno()).st_ino
+        return f
+
+    def new_pack_name(self):
+        base = os.path.splitext(os.path.basename(self.index_path))[0]
+        return '%s-%x-%d-%d.pack' % (base, int(time.time() * 1000), os.getpid(), next(pack_counter))
+
+    def put(self, name, mtime, size, data):
+        with self.lock:
+            with self.locked_index() as index:
+                with open(self.get_pack_path(), 'ab') as pack:
+                    offset = os.fstat(pack.fileno()).st_size
+                    pack.write(data)
+                index.write(dumps([name, mtime, size, offset, len(data)]))
+                if name in self.entries:
+                    self.dead_bytes += self.entries[name][3]
+                self.entries[name] = mtime, size, offset, len(data)
+
+    def remove(self, name):
+        with self.lock:
+            if name not in self.entries:
+                return
+            with self.locked_index() as index:
+                index.write(dumps([name, None, None, 0, None]))
+                if name in self.entries:
+                    self.dead_bytes += self.entries.pop(name)[3]
+
+    def get_live_bytes(self):
+        with self.lock:
+            return sum(e[3] for e in self.entries.values())
+
+    def compact(self, is_current=None):
+        """
+        Rewrites the pack without replaced and removed thumbnails, and without the ones is_current(name, mtime, size)
+        rejects. Returns the number of bytes freed.
+        """
+        with self.lock:
+            with self.locked_index():
+                old_pack = self.get_pack_path()
+                old_size = self.get_pack_size()
+                kept = dict((name, entry) for name, entry in self.entries.items()
+                            if not is_current or is_current(name, entry[0], entry[1]))
+                new_name = self.new_pack_name()
+                new_entries = {}
+                tmp_index = self.index_path + '.tmp'
+                with open(os.path.join(self.root, new_name), 'wb') as pack:
+                    with open(tmp_index, 'w') as index:
+                        index.write(dumps({'folder': self.folder, 'pack': new_name}))
+                        for name, (mtime, size, offset, length) in sorted(kept.items(), key=lambda e: e[1][2]):
+                            data = self.get(name, mtime, size)
+                            if data is None:
+                                continue
+                            new_offset = pack.tell()
+                            pack.write(data)
+                            index.write(dumps([name, mtime, size, new_offset, len(data)]))
+                            new_entries[name] = mtime, size, new_offset, len(data)
+                # the switch: other processes see either the old index and pack, or the new ones
+                os.rename(tmp_index, self.index_path)
+                self.close()
+                self.pack_name = new_name
+                self.entries = new_entries
+                self.dead_bytes = 0
+                self.index_inode = os.stat(self.index_path).st_ino
+                if old_pack and os.path.exists(old_pack):
+                    os.unlink(old_pack)
+                return old_size - self.get_pack_size()
+
+    def delete(self):
+        with self.lock:
+            self.close()
+            for path in (self.get_pack_path(), self.index_path):
+                if path and os.path.exists(path):
+                    os.unlink(path)
+            self.entries = {}
+            self.pack_name = None
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+
+
+class PackStore(object):
+    """
+    The default thumbnail store: a ThumbPack per folder in root, bounded in size and age like ThumbnailCache, and
+    with the same interface for stats and pruning. A folder's pack is opened (and its index read) on first use.
+    The mtime of an index is the last time the viewer used its pack - stats and pruning leave it alone.
+    """
+
+    def __init__(self, root, max_bytes, max_age):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = threading.RLock()
+        self.packs = {}
+        self.used = set()   # folders whose packs were marked as used in this session
+
+    def get_pack(self, folder):
+        with self.lock:
+            pack = self.packs.get(folder)
+            if pack is None:
+                pack = self.packs[folder] = ThumbPack(self.root, folder)
+            return pack
+
+    def use_pack(self, folder):
+        """get_pack() for the viewer: also records the use, once per session, for pruning"""
+        pack = self.get_pack(folder)
+        with self.lock:
+            if folder in self.used:
+                return pack
+            self.used.add(folder)
+        try:
+            os.utime(pack.index_path, None)
+        except OSError:
+            pass    # no index yet - put() creates it
+        return pack
+
+    def get(self, filename, mtime, size):
+        return self.use_pack(os.path.dirname(filename)).get(os.path.basename(filename), mtime, size)
+
+    def put(self, filename, mtime, size, data):
+        self.use_pack(os.path.dirname(filename)).put(os.path.basename(filename), mtime, size, data)
+
+    def remove(self, filename):
+        self.get_pack(os.path.dirname(filename)).remove(os.path.basename(filename))
+
+    def flush(self):
+        pass    # every put() is written right away
+
+    def close(self):
+        with self.lock:
+            for pack in self.packs.values():
+                pack.close()
+            self.packs = {}
+
+    def list_indexes(self):
+        if not os.path.isdir(self.root):
+            return []
+        return [os.path.join(self.root, name) for name in os.listdir(self.root) if name.endswith('.idx')]
+
+    def load_all(self):
+        """All packs in root, by folder"""
+        packs = {}
+        for index_path in self.list_indexes():
+            try:
+                with open(index_path) as f:
+                    folder = json.loads(f.readline())['folder'].encode('latin-1')
+            except (IOError, ValueError, KeyError):
+                continue
+            packs[folder] = self.get_pack(folder)
+        return packs
+
+    def stats(self):
+        packs = self.load_all().values()
+        count = sum(len(p.entries) for p in packs)
+        return {
+            'count': count,
+            'bytes': sum(p.get_pack_size() for p in packs),
+            'indexed': count,
+            'legacy_count': 0,
+            'legacy_bytes': 0,
+            'max_bytes': self.max_bytes,
+            'max_age_days': self.max_age / 86400.0,
+            'last_gc': self.get_last_gc(),
+        }
+
+    def prune(self, now=None):
+        """
+        Deletes the packs of folders that are gone or were not opened for max_age, compacts the ones with too much
+        outdated data, and then deletes the least recently used packs until the store fits max_bytes.
+        Returns (thumbnails removed, bytes freed).
+        """
+        now = now or time.time()
+        removed = [0, 0]
+
+        def _delete(pack):
+            removed[0] += len(pack.entries)
+            removed[1] += pack.get_pack_size()
+            pack.delete()
+            with self.lock:
+                self.packs.pop(pack.folder, None)
+
+        def _is_current(folder):
+            def _check(name, mtime, size):
+                try:
+                    st = os.stat(os.path.join(folder, name))
+                except OSError:
+                    return False
+                return st.st_mtime == mtime and st.st_size == size
+            return _check
+
+        kept = []
+        for folder, pack in self.load_all().items():
+            try:
+                last_used = os.path.getmtime(pack.index_path)
+            except OSError:
+                continue
+            if not os.path.isdir(folder) or now - last_used > self.max_age:
+                _delete(pack)
+                continue
+            is_current = _is_current(folder)
+            outdated = sum(e[3] for name, e in pack.entries.items() if not is_current(name, e[0], e[1]))
+            total = pack.get_pack_size()
+            if total and float(pack.dead_bytes + outdated) / total >= COMPACT_RATIO:
+                count = len(pack.entries)
+                removed[1] += pack.compact(is_current)
+                removed[0] += count - len(pack.entries)
+            kept.append((last_used, pack))
+
+        total = sum(p.get_pack_size() for t, p in kept)
+        for last_used, pack in sorted(kept):
+            if total <= self.max_bytes:
+                break
+            total -= pack.get_pack_size()
+            _delete(pack)
+
+        # packs no index points to anymore, e.g. after a crash during compaction
+        referenced = set(p.pack_name for p in self.load_all().values())
+        if os.path.isdir(self.root):
+            for name in os.listdir(self.root):
+                if name.endswith('.pack') and name not in referenced:
+                    path = os.path.join(self.root, name)
+                    if now - os.path.getmtime(path) > 3600:     # not one being created right now
+                        removed[1] += os.path.getsize(path)
+                        os.unlink(path)
+
+        self.set_last_gc(now)
+        return removed[0], removed[1]
+
+    def get_last_gc(self):
+        try:
+            return os.path.getmtime(os.path.join(self.root, LAST_GC_NAME))
+        except OSError:
+            return None
+
+    def set_last_gc(self, now):
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        stamp = os.path.join(self.root, LAST_GC_NAME)
+        open(stamp, 'w').close()
+        os.utime(stamp, (now, now))
+
+    def needs_gc(self, interval, now=None):
+        last = self.get_last_gc()
+        return last is None or (now or time.time()) - last > interval
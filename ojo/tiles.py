@@ -0,0 +1,250 @@
+# Tiled rendering for images too big to decode into a single pixbuf at 100% zoom.
+# The pyramid is built with PIL (in the thumbnail worker processes when possible) and spilled to disk as tiles;
+# the viewer only ever keeps the tiles it is currently drawing in memory.
+# GTK is only imported by TiledView, the rest is safe to use in forked workers.
+
+import json
+import math
+import os
+import shutil
+import logging
+from cache import LruCache, pixbuf_size
+from util import write_atomically   # the viewer picks up tiles while the pyramid is still being built
+
+TILE_SIZE = 512
+
+INFO_NAME = 'info.json'
+DONE_NAME = 'done'
+ERROR_NAME = 'error'
+
+
+def level_sizes(size, tile_size=TILE_SIZE):
+    """Sizes of the pyramid levels - each level is half the previous one, down to one that fits in a tile"""
+    sizes = [tuple(size)]
+    while sizes[-1][0] > tile_size or sizes[-1][1] > tile_size:
+        w, h = sizes[-1]
+        sizes.append((max(1, w // 2), max(1, h // 2)))
+    return sizes
+
+
+def level_for_scale(scale, level_count):
+    """The smallest of level_count halving levels that still has as many pixels as we need to display at scale"""
+    if scale >= 1:
+        return 0
+    return min(level_count - 1, int(math.floor(math.log(1.0 / scale, 2) + 1e-9)))
+
+
+class TilePyramid(object):
+    """
+    A tile pyramid spilled to disk: level 0 is the full-size image, tiles are PPM files in
+    <spill_dir>/<level>/<col>_<row>.ppm. The builder writes info.json with the actual size once the image is
+    decoded, each tile as soon as it is ready, and finally a 'done' marker - or an 'error' one, with the reason.
+    """
+
+    def __init__(self, spill_dir, expected_size, tile_size=TILE_SIZE):
+        self.spill_dir = spill_dir
+        self.tile_size = tile_size
+        self.size = tuple(expected_size)
+        self.levels = level_sizes(self.size, tile_size)
+        self.size_known = False
+        self.load_info()
+
+    def load_info(self):
+        """Picks up the real size from the builder. Returns True if the size changed."""
+        if self.size_known:
+            return False
+        try:
+            with open(os.path.join(self.spill_dir, INFO_NAME)) as f:
+                size = tuple(json.load(f)['size'])
+        except (IOError, ValueError, KeyError):
+            return False
+        self.size_known = True
+        if size == self.size:
+            return False
+        self.size = size
+        self.levels = level_sizes(size, self.tile_size)
+        return True
+
+    def is_complete(self):
+        return os.path.exists(os.path.join(self.spill_dir, DONE_NAME))
+
+    def has_failed(self):
+        return os.path.exists(os.path.join(self.spill_dir, ERROR_NAME))
+
+    def level_for_scale(self, scale):
+        return level_for_scale(scale, len(self.levels))
+
+    def tile_path(self, level, col, row):
+        return os.path.join(self.spill_dir, str(level), '%d_%d.ppm' % (col, row))
+
+    def tile_box(self, level, col, row):
+        w, h = self.levels[level]
+        x, y = col * self.tile_size, row * self.tile_size
+        return x, y, min(self.tile_size, w - x), min(self.tile_size, h - y)
+
+    def tiles_in(self, level, x1, y1, x2, y2):
+        """(col, row) of the level's tiles that intersect the given rectangle, in level coordinates"""
+        w, h = self.levels[level]
+        cols = range(max(0, int(x1) // self.tile_size), min(int(math.ceil(float(w) / self.tile_size)),
+                                                           int(math.ceil(float(x2) / self.tile_size))))
+        rows = range(max(0, int(y1) // self.tile_size), min(int(math.ceil(float(h) / self.tile_size)),
+                                                           int(math.ceil(float(y2) / self.tile_size))))
+        return [(col, row) for row in rows for col in cols]
+
+
+def build_pyramid(filename, orientation, spill_dir, tile_size=TILE_SIZE):
+    """Decodes filename once and writes all pyramid levels into spill_dir"""
+    from PIL import Image
+    import thumbnails
+
+    if not os.path.isdir(spill_dir):
+        os.makedirs(spill_dir)
+    im = thumbnails.open_image(filename)
+    if im.mode != 'RGB':
+        im = im.convert('RGB')
+    im = thumbnails.auto_rotate(orientation, im)
+    write_atomically(os.path.join(spill_dir, INFO_NAME), lambda f: json.dump({'size': im.size}, f))
+
+    for level, size in enumerate(level_sizes(im.size, tile_size)):
+        if im.size != size:
+            im = im.resize(size, Image.ANTIALIAS)
+        folder = os.path.join(spill_dir, str(level))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        for row in range(int(math.ceil(float(size[1]) / tile_size))):
+            for col in range(int(math.ceil(float(size[0]) / tile_size))):
+                box = (col * tile_size, row * tile_size,
+                       min(size[0], (col + 1) * tile_size), min(size[1], (row + 1) * tile_size))
+                tile = im.crop(box)
+                write_atomically(os.path.join(folder, '%d_%d.ppm' % (col, row)), lambda f: tile.save(f, 'PPM'))
+    open(os.path.join(spill_dir, DONE_NAME), 'w').close()
+
+
+def build_pyramid_job(filename, orientation, spill_dir, tile_size=TILE_SIZE):
+    """
+    Entry point for the worker processes: never raises, returns (spill_dir, error or None). A failure is also
+    recorded in spill_dir, for the view waiting on the pyramid.
+    """
+    try:
+        build_pyramid(filename, orientation, spill_dir, tile_size)
+        return spill_dir, None
+    except Exception, e:
+        try:
+            if not os.path.isdir(spill_dir):
+                os.makedirs(spill_dir)
+            write_atomically(os.path.join(spill_dir, ERROR_NAME), lambda f: f.write(str(e)))
+        except EnvironmentError:
+            pass
+        return spill_dir, str(e)
+
+
+def prune_spill(root, keep):
+    """Deletes all pyramids in root except the ones in keep"""
+    if not os.path.isdir(root):
+        return
+    keep = set(os.path.normpath(k) for k in keep)
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if os.path.normpath(path) not in keep:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+class TiledView(object):
+    """
+    Draws a TilePyramid in a Gtk.DrawingArea. Only the tiles intersecting the exposed area are loaded, from an
+    LRU cache of cache_bytes - tiles that went off screen are the first to be evicted. Until a tile is ready,
+    the placeholder pixbuf (e.g. the fit-to-window rendition) is drawn scaled up in its place.
+    """
+
+    def __init__(self, filename, pyramid, cache_bytes, placeholder=None):
+        from gi.repository import Gtk
+        self.filename = filename
+        self.pyramid = pyramid
+        self.placeholder = placeholder
+        self.scale = 1.0
+        self.tiles = LruCache(cache_bytes, sizeof=pixbuf_size)
+        self.area = Gtk.DrawingArea()
+        self.area.set_halign(Gtk.Align.CENTER)
+        self.area.set_valign(Gtk.Align.CENTER)
+        self.area.connect('draw', self.on_draw)
+        self.area.set_visible(True)
+        self.update_size()
+
+    def get_display_size(self):
+        w, h = self.pyramid.size
+        return max(1, int(w * self.scale)), max(1, int(h * self.scale))
+
+    def update_size(self):
+        self.area.set_size_request(*self.get_display_size())
+
+    def set_scale(self, scale):
+        if scale != self.scale:
+            self.scale = scale
+            self.update_size()
+            self.area.queue_draw()
+
+    def watch_build(self, on_failed=None):
+        """
+        Redraws periodically while the pyramid is being built, so that tiles appear as they get ready. If the build
+        fails, calls on_failed() and stops.
+        """
+        from gi.repository import GObject
+
+        def _poll():
+            if not self.area.get_parent():
+                return False    # no longer shown
+            if self.pyramid.has_failed():
+                if on_failed:
+                    on_failed()
+                return False
+            if self.pyramid.load_info():
+                self.update_size()
+            self.area.queue_draw()
+            return not self.pyramid.is_complete()
+        GObject.timeout_add(250, _poll)
+
+    def get_tile(self, level, col, row):
+        from gi.repository import GdkPixbuf, GObject
+        key = level, col, row
+        pixbuf = self.tiles.get(key)
+        if pixbuf is None:
+            path = self.pyramid.tile_path(level, col, row)
+            if not os.path.exists(path):
+                return None
+            try:
+                pixbuf = GdkPixbuf.Pixbuf.new_from_file(path)
+            except GObject.GError:
+                logging.exception("Could not load tile %s" % path)
+                return None
+            self.tiles[key] = pixbuf
+        return pixbuf
+
+    def on_draw(self, area, cr):
+        from gi.repository import Gdk
+        x1, y1, x2, y2 = cr.clip_extents()
+        display_w, display_h = self.get_display_size()
+
+        if self.placeholder:
+            cr.save()
+            cr.scale(float(display_w) / self.placeholder.get_width(), float(display_h) / self.placeholder.get_height())
+            Gdk.cairo_set_source_pixbuf(cr, self.placeholder, 0, 0)
+            cr.paint()
+            cr.restore()
+
+        level = self.pyramid.level_for_scale(self.scale)
+        level_w, level_h = self.pyramid.levels[level]
+        fx, fy = float(display_w) / level_w, float(display_h) / level_h
+        visible = [(level, col, row) for col, row in self.pyramid.tiles_in(level, x1 / fx, y1 / fy, x2 / fx, y2 / fy)]
+        self.tiles.set_protected(visible)
+
+        cr.save()
+        cr.scale(fx, fy)
+        for key in visible:
+            pixbuf = self.get_tile(*key)
+            if pixbuf:
+                x, y, w, h = self.pyramid.tile_box(*key)
+                Gdk.cairo_set_source_pixbuf(cr, pixbuf, x, y)
+                cr.rectangle(x, y, w, h)
+                cr.fill()
+        cr.restore()
+        return True
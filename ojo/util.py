@@ -48,6 +48,46 @@ def makedirs(path):
     return path
 
 
+def write_atomically(target, write):
+    """
+    Calls write(f) with a new file next to target, which then replaces target at once: readers, also in other
+    processes, never see a half-written file. The file is private (0600) and named *.tmp until it is complete.
+    """
+    import tempfile
+    folder = os.path.dirname(target)
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder, 0700)
+        except OSError:
+            if not os.path.isdir(folder):   # else created meanwhile
+                raise
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=folder)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.rename(tmp, target)
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
+def to_unicode(value):
+    """
+    Decodes the byte strings in value (also inside lists, tuples and dicts) for JSON: as UTF-8 where they are valid
+    UTF-8, as latin-1 (one character per byte) where not - e.g. a filename in a legacy encoding.
+    """
+    if isinstance(value, str):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return value.decode('latin-1')
+    elif isinstance(value, (list, tuple)):
+        return [to_unicode(v) for v in value]
+    elif isinstance(value, dict):
+        return dict((to_unicode(k), to_unicode(v)) for k, v in value.items())
+    return value
+
+
 def path2url(path):
     import urllib
     return 'file://' + urllib.pathname2url(path)
@@ -0,0 +1,120 @@
+# Read and write support for the shared freedesktop.org thumbnail cache (~/.cache/thumbnails), as per
+# https://specifications.freedesktop.org/thumbnail-spec/thumbnail-spec-latest.html
+# Only the standard library (and util) is used, this module is also used by the thumbnail worker processes.
+# Imports are lazy as this gets imported on startup.
+
+import os
+import struct
+from util import write_atomically
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+# flavors and the maximal thumbnail dimension for each of them
+FLAVORS = (('normal', 128), ('large', 256), ('x-large', 512), ('xx-large', 1024))
+
+
+def get_thumbnails_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'thumbnails')
+
+
+def file_uri(path):
+    import urllib
+    # escaped the same way as GLib's g_filename_to_uri, so that our MD5s match those of other applications
+    return 'file://' + urllib.quote(os.path.abspath(path), safe="/!$&'()*+,:=@~")
+
+
+def thumbnail_path(path, flavor):
+    import hashlib
+    return os.path.join(get_thumbnails_dir(), flavor, hashlib.md5(file_uri(path)).hexdigest() + '.png')
+
+
+def fail_path(path, app):
+    import hashlib
+    return os.path.join(get_thumbnails_dir(), 'fail', app, hashlib.md5(file_uri(path)).hexdigest() + '.png')
+
+
+def read_png_info(thumb_path):
+    """Returns ((width, height), {tEXt key: value}) of a PNG, reading only the chunks before the image data"""
+    with open(thumb_path, 'rb') as f:
+        if f.read(8) != PNG_SIGNATURE:
+            raise IOError('Not a PNG: %s' % thumb_path)
+        size = None
+        text = {}
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                break
+            length, chunk_type = struct.unpack('>I4s', header)
+            if chunk_type in ('IDAT', 'IEND'):
+                break
+            data = f.read(length)
+            f.seek(4, os.SEEK_CUR)  # CRC
+            if chunk_type == 'IHDR':
+                size = struct.unpack('>II', data[:8])
+            elif chunk_type == 'tEXt' and '\0' in data:
+                key, value = data.split('\0', 1)
+                text[key] = value
+        return size, text
+
+
+def is_valid(thumb_path, path, mtime):
+    try:
+        size, text = read_png_info(thumb_path)
+        return text.get('Thumb::URI') == file_uri(path) and text.get('Thumb::MTime') == str(int(mtime))
+    except Exception:
+        return False
+
+
+def lookup(path, mtime, min_height):
+    """
+    Returns the path of the smallest valid shared thumbnail of path that is at least min_height high
+    (or that is not downscaled at all), or None if there is none.
+    """
+    for flavor, max_size in FLAVORS:
+        thumb = thumbnail_path(path, flavor)
+        if not os.path.exists(thumb):
+            continue
+        try:
+            size, text = read_png_info(thumb)
+        except Exception:
+            continue
+        if text.get('Thumb::URI') != file_uri(path) or text.get('Thumb::MTime') != str(int(mtime)):
+            continue
+        original_height = text.get('Thumb::Image::Height')
+        if size and (size[1] >= min_height or (original_height and int(original_height) <= size[1])):
+            return thumb
+    return None
+
+
+def is_failed(path, mtime, app=None):
+    """Whether app - or, if None, any application - recorded that it could not thumbnail path as of mtime"""
+    if app:
+        return is_valid(fail_path(path, app), path, mtime)
+    fail_dir = os.path.join(get_thumbnails_dir(), 'fail')
+    apps = os.listdir(fail_dir) if os.path.isdir(fail_dir) else []
+    return any(is_valid(fail_path(path, a), path, mtime) for a in apps)
+
+
+def save(pil_image, path, mtime, flavor, original_size=None):
+    """Saves pil_image (already scaled to fit the flavor's size) as the shared thumbnail of path"""
+    from PIL.PngImagePlugin import PngInfo
+    info = PngInfo()
+    info.add_text('Thumb::URI', file_uri(path))
+    info.add_text('Thumb::MTime', str(int(mtime)))
+    info.add_text('Software', 'Ojo')
+    if original_size:
+        info.add_text('Thumb::Image::Width', str(original_size[0]))
+        info.add_text('Thumb::Image::Height', str(original_size[1]))
+    thumb = thumbnail_path(path, flavor)
+    write_atomically(thumb, lambda f: pil_image.save(f, 'PNG', pnginfo=info))
+    return thumb
+
+
+def save_failure(path, mtime, app):
+    from PIL import Image
+    from PIL.PngImagePlugin import PngInfo
+    info = PngInfo()
+    info.add_text('Thumb::URI', file_uri(path))
+    info.add_text('Thumb::MTime', str(int(mtime)))
+    write_atomically(fail_path(path, app), lambda f: Image.new('RGBA', (1, 1)).save(f, 'PNG', pnginfo=info))
@@ -1,30 +1,280 @@
 #!/usr/bin/python
+# Benchmarks for the imaging pipeline, run headless on synthetic corpora.
+#
+#   python tests/experiments/benchmarks.py [-o results.json] [--corpus DIR] [--entries 10000,100000] [-r 3]
+#
+# The corpus is generated once in DIR (a temporary folder by default) and contains JPEGs with every EXIF
+# orientation, PNGs, animated GIFs, fake RAW files (TIFF containers with an embedded JPEG preview, like most
+# RAW formats), and folders with many entries. Results are written as JSON, so that releases can be compared
+# on the same hardware.
 
-from pyexiv2 import ImageMetadata
+import json
+import optparse
 import os
+import platform
+import shutil
+import struct
+import sys
+import tempfile
 import time
+import traceback
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
 from gi.repository import GdkPixbuf
+from PIL import Image
 
-dir = '/d/Pics/Wallpapers/Favorites'
+from ojo import ojo, ojoconfig, scanner, thumbnails
+from ojo.cache import LruCache
 
-s = time.time()
-i = 0
-for i, f in enumerate(os.listdir(dir)):
-    try:
-        file = os.path.join(dir, f)
-        GdkPixbuf.Pixbuf.get_file_info(file)
-    except Exception:
-        pass
-print i, time.time() - s
-
-s = time.time()
-i = 0
-for i, f in enumerate(os.listdir(dir)):
+IMAGE_SIZE = (3000, 2000)
+FIT_SIZE = (1600, 1000)
+
+
+# --- Synthetic corpus ---
+
+def tiff_ifd(entries, next_ifd=0):
+    """A little-endian TIFF IFD, entries are (tag, type, value) with SHORT (3) or LONG (4) values"""
+    data = struct.pack('<H', len(entries))
+    for tag, type, value in sorted(entries):
+        value = struct.pack('<HH', value, 0) if type == 3 else struct.pack('<I', value)
+        data += struct.pack('<HHI', tag, type, 1) + value
+    return data + struct.pack('<I', next_ifd)
+
+
+def exif_orientation(orientation):
+    """APP1 payload with just an Orientation tag"""
+    tiff = 'II*\0' + struct.pack('<I', 8) + tiff_ifd([(0x0112, 3, orientation)])
+    return 'Exif\0\0' + tiff
+
+
+def gradient(size, seed=0):
+    # something with detail, so that JPEG encoding and decoding do realistic work
+    small = Image.new('RGB', (64, 64))
+    small.putdata([((x * 4 + seed) % 256, (y * 4) % 256, ((x ^ y) * 4) % 256) for y in range(64) for x in range(64)])
+    return small.resize(size, Image.BICUBIC)
+
+
+def write_jpeg(path, size, orientation):
+    gradient(size, orientation * 16).save(path, 'JPEG', quality=90, exif=exif_orientation(orientation))
+
+
+def write_fake_raw(path, size, orientation):
+    """A TIFF container without any decodable image data, only an embedded full-size JPEG preview"""
+    import cStringIO
+    buf = cStringIO.StringIO()
+    gradient(size, 7).save(buf, 'JPEG', quality=90)
+    preview = buf.getvalue()
+    entries = [(0x0100, 4, size[0]), (0x0101, 4, size[1]), (0x0112, 3, orientation),
+               (0x0201, 4, 0), (0x0202, 4, len(preview))]
+    preview_offset = 8 + len(tiff_ifd(entries))
+    entries[3] = (0x0201, 4, preview_offset)
+    with open(path, 'wb') as f:
+        f.write('II*\0' + struct.pack('<I', 8) + tiff_ifd(entries) + preview)
+
+
+def write_animated_gif(path, size, frames=10):
+    images = [gradient(size, i * 25).convert('P') for i in range(frames)]
+    images[0].save(path, 'GIF', save_all=True, append_images=images[1:], duration=100, loop=0)
+
+
+def make_corpus(root, entries):
+    images = os.path.join(root, 'images')
+    if not os.path.isdir(images):
+        os.makedirs(images)
+        for orientation in range(1, 9):
+            write_jpeg(os.path.join(images, 'photo_%d.jpg' % orientation), IMAGE_SIZE, orientation)
+        for i in range(4):
+            gradient(IMAGE_SIZE, i).save(os.path.join(images, 'image_%d.png' % i), 'PNG')
+        for i in range(2):
+            write_animated_gif(os.path.join(images, 'anim_%d.gif' % i), (500, 400))
+        for orientation in (1, 6):
+            write_fake_raw(os.path.join(images, 'raw_%d.dng' % orientation), IMAGE_SIZE, orientation)
+
+    folders = {}
+    for count in entries:
+        folder = os.path.join(root, 'entries_%d' % count)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+            for i in range(count):
+                # listing and sorting only look at names and stat info, contents do not matter
+                ext = ('.jpg', '.png', '.cr2', '.txt')[i % 4]
+                open(os.path.join(folder, 'file_%06d%s' % (i, ext)), 'w').close()
+        folders[count] = folder
+    return images, folders
+
+
+# --- Headless Ojo ---
+
+def headless_ojo(cache_dir):
+    """An Ojo without a window or browser, with default options and caches in cache_dir"""
+    viewer = ojo.Ojo.__new__(ojo.Ojo)
+    viewer.load_json = lambda filename, default_data: {}
+    viewer.load_options()
+    viewer.options['freedesktop_thumbnails'] = 'off'
+    viewer.get_cache_dir = lambda: cache_dir
+    viewer.init_caches()
+    viewer.file_cache = LruCache(0)     # every decode reads its file, as on a first visit
+    viewer.zoom = False
+    return viewer
+
+
+def reset(viewer):
+    viewer.meta_cache.clear()
+    viewer.pix_cache[False].clear()
+    viewer.pix_cache[True].clear()
+
+
+# --- Timing ---
+
+def measure(name, func, items, repeat, setup=None):
+    """
+    Runs func over all items repeat times, returns per-item timings in ms. The first failure is printed with its
+    traceback and kept in the result - a benchmark that only measures exceptions is worthless.
+    """
+    timings = []
+    failures = 0
+    error = None
+    for i in range(repeat):
+        for item in items:
+            if setup:
+                setup(item)
+            start = time.time()
+            try:
+                func(item)
+            except Exception:
+                failures += 1
+                if error is None:
+                    error = traceback.format_exc()
+                    print >> sys.stderr, '%s failed on %s:\n%s' % (name, item, error)
+                continue
+            timings.append((time.time() - start) * 1000)
+    timings.sort()
+    result = {
+        'items': len(items),
+        'repeat': repeat,
+        'failures': failures,
+        'error': error,
+        'min_ms': timings[0] if timings else None,
+        'median_ms': timings[len(timings) // 2] if timings else None,
+        'mean_ms': sum(timings) / len(timings) if timings else None,
+        'max_ms': timings[-1] if timings else None,
+    }
+    print '%-32s %6d runs  median %9.2f ms  min %9.2f ms  failures %d' % (
+        name, len(timings), result['median_ms'] or 0, result['min_ms'] or 0, failures)
+    return result
+
+
+def run(corpus_dir, entries, repeat):
+    images_folder, entry_folders = make_corpus(corpus_dir, entries)
+    cache_dir = tempfile.mkdtemp(prefix='ojo-bench-cache-')
+    viewer = headless_ojo(cache_dir)
+    images = sorted(os.path.join(images_folder, f) for f in os.listdir(images_folder))
+    jpegs = [f for f in images if f.endswith('.jpg')]
+    results = {}
+
+    def _list(folder):
+        viewer.folder_model = scanner.scan_folder(folder)
+        viewer.get_image_list()
+    for count, folder in sorted(entry_folders.items()):
+        results['get_image_list/%d' % count] = measure('get_image_list/%d' % count, _list, [folder], repeat)
+    viewer.folder_model = None
+
+    results['get_meta'] = measure('get_meta', viewer.get_meta, images, repeat, setup=lambda f: reset(viewer))
+
+    for kind, files in (('jpeg', jpegs), ('png', [f for f in images if f.endswith('.png')]),
+                        ('gif', [f for f in images if f.endswith('.gif')]),
+                        ('raw', [f for f in images if f.endswith('.dng')])):
+        for zoom in (False, True):
+            name = 'get_pixbuf/%s/%s' % (kind, 'zoom' if zoom else 'fit')
+            results[name] = measure(
+                name, lambda f: viewer.get_pixbuf(f, True, zoom, FIT_SIZE[0], FIT_SIZE[1]), files, repeat,
+                setup=lambda f: reset(viewer))
+
+    def _clear_thumb(f):
+        reset(viewer)
+        cached = viewer.get_cached_thumbnail_path(f, True)
+        if os.path.exists(cached):
+            os.unlink(cached)
+    for mode in ('full', 'embedded'):
+        viewer.options['thumbnail_mode'] = mode
+        name = 'prepare_thumbnail/%s' % mode
+        results[name] = measure(
+            name, lambda f: viewer.prepare_thumbnail(f, 360, 120),
+            [f for f in images if not f.endswith('.gif')], repeat, setup=_clear_thumb)
+
+    # the default 'pack' store: filing a fresh thumbnail into its folder pack, and finding it there again
+    def _prepare_unpacked(f):
+        _clear_thumb(f)
+        viewer.prepare_thumbnail(f, 360, 120)
+    results['store_thumbnail/pack'] = measure(
+        'store_thumbnail/pack', lambda f: viewer.store_thumbnail(f, viewer.get_cached_thumbnail_path(f, True)),
+        jpegs, repeat, setup=_prepare_unpacked)
+    results['find_thumbnail/pack'] = measure('find_thumbnail/pack', viewer.find_thumbnail, jpegs, repeat)
+
+    pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(jpegs[0], FIT_SIZE[0], FIT_SIZE[1], True)
+    results['auto_rotate_pixbuf'] = measure(
+        'auto_rotate_pixbuf', lambda o: viewer.auto_rotate_pixbuf(o, pixbuf), range(1, 9), repeat)
+    pil_image = gradient(FIT_SIZE)
+    results['auto_rotate_pil'] = measure(
+        'auto_rotate_pil', lambda o: thumbnails.auto_rotate(o, pil_image), range(1, 9), repeat)
+    results['pil_to_pixbuf'] = measure('pil_to_pixbuf', viewer.pil_to_pixbuf, [pil_image], repeat)
+
+    # decoding strategies, for reference
+    results['decode/gdk_full_and_scale'] = measure(
+        'decode/gdk_full_and_scale',
+        lambda f: GdkPixbuf.Pixbuf.new_from_file(f).scale_simple(
+            FIT_SIZE[0], FIT_SIZE[1], GdkPixbuf.InterpType.BILINEAR), jpegs, repeat)
+    results['decode/gdk_at_scale'] = measure(
+        'decode/gdk_at_scale',
+        lambda f: GdkPixbuf.Pixbuf.new_from_file_at_scale(f, FIT_SIZE[0], FIT_SIZE[1], True), jpegs, repeat)
+
+    def _pil_draft(f):
+        im = Image.open(f)
+        im.draft(im.mode, (360, 360))
+        im.thumbnail((360, 360))
+    results['decode/pil_draft_thumbnail'] = measure('decode/pil_draft_thumbnail', _pil_draft, jpegs, repeat)
+
+    shutil.rmtree(cache_dir)
+    return results
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-o', '--output', help='Write the results as JSON to this file (default: stdout)')
+    parser.add_option('--corpus', help='Folder for the synthetic corpus, reused if it exists (default: a temp folder)')
+    parser.add_option('--entries', default='10000,100000',
+                      help='Comma-separated entry counts of the folders to list (default: %default)')
+    parser.add_option('-r', '--repeat', type='int', default=3, help='Runs per item (default: %default)')
+    options, args = parser.parse_args()
+
+    corpus_dir = options.corpus or tempfile.mkdtemp(prefix='ojo-bench-corpus-')
+    entries = [int(e) for e in options.entries.split(',') if e]
     try:
-        file = os.path.join(dir, f)
-        meta = ImageMetadata(file)
-        meta.read()
-    except Exception:
-        pass
-print i, time.time() - s
+        results = run(corpus_dir, entries, options.repeat)
+    finally:
+        if not options.corpus:
+            shutil.rmtree(corpus_dir)
+
+    report = {
+        'ojo_version': ojoconfig.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'repeat': options.repeat,
+        'results': results,
+    }
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=4, sort_keys=True)
+    else:
+        print json.dumps(report, indent=4, sort_keys=True)
+
+    broken = sorted(name for name, result in results.items() if result['failures'] and result['min_ms'] is None)
+    if broken:
+        sys.exit('Every item failed in: %s' % ', '.join(broken))
+
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+import os
+import tempfile
+import unittest
+from ojo import animation
+
+
+class FakeAnimation(object):
+    def get_width(self):
+        return 100
+
+    def get_height(self):
+        return 50
+
+
+class TestAnimation(unittest.TestCase):
+    def test_may_be_animated(self):
+        self.assertTrue(animation.may_be_animated('/a/b.GIF'))
+        self.assertTrue(animation.may_be_animated('b.mng'))
+        self.assertFalse(animation.may_be_animated('b.png'))
+        self.assertFalse(animation.may_be_animated('gif'))
+
+    def test_animation_size(self):
+        fd, path = tempfile.mkstemp(suffix='.gif')
+        try:
+            os.write(fd, 'x' * 10)
+            os.close(fd)
+            self.assertEquals(100 * 50 * 4, animation.animation_size(FakeAnimation(), path))
+            with open(path, 'wb') as f:
+                f.write('x' * 100000)
+            self.assertEquals(400000, animation.animation_size(FakeAnimation(), path))
+        finally:
+            os.unlink(path)
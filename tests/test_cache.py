@@ -0,0 +1,39 @@
+import unittest
+from ojo.cache import LruCache
+
+
+class TestLruCache(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LruCache(10)
+        cache['a'] = 'xxxx'
+        cache['b'] = 'xxxx'
+        cache['a']
+        cache['c'] = 'xxxx'
+        self.assertEquals(['a', 'c'], sorted(cache.keys()))
+        self.assertEquals(8, cache.total_bytes)
+
+    def test_protected_evicted_last(self):
+        cache = LruCache(10)
+        cache['a'] = 'xxxx'
+        cache['b'] = 'xxxx'
+        cache.set_protected(['a'])
+        cache['c'] = 'xxxx'
+        self.assertEquals(['a', 'c'], sorted(cache.keys()))
+
+    def test_oversized_entry_is_kept(self):
+        cache = LruCache(10)
+        cache['a'] = 'xxxx'
+        cache['big'] = 'x' * 20
+        self.assertEquals(['big'], cache.keys())
+        self.assertEquals(None, cache.pop('a'))
+        self.assertEquals('x' * 20, cache.pop('big'))
+        self.assertEquals(0, cache.total_bytes)
+
+    def test_protected_evicted_farthest_first(self):
+        cache = LruCache(30)
+        keys = ['p%d' % i for i in range(10)]     # closest to the current image first
+        cache.set_protected(keys)
+        for key in keys:
+            cache[key] = 'x' * 10
+        self.assertEquals(['p0', 'p1', 'p2'], sorted(cache.keys()))
+        self.assertEquals(30, cache.total_bytes)
@@ -0,0 +1,43 @@
+import threading
+import unittest
+from ojo.decodequeue import DecodeQueue
+
+
+class TestDecodeQueue(unittest.TestCase):
+    def test_priority_order(self):
+        queue = DecodeQueue()
+        generation = queue.submit(['shown', 'next', 'previous', 'next'])
+        self.assertEquals(['shown', 'next', 'previous'], queue.pending())
+        self.assertEquals(('shown', generation), queue.get())
+        self.assertEquals(('next', generation), queue.get())
+
+    def test_stale_requests_dropped(self):
+        queue = DecodeQueue()
+        queue.submit(['a', 'b', 'c'])
+        generation = queue.submit(['d', 'c'])
+        self.assertEquals(['d', 'c'], queue.pending())
+        self.assertEquals(('d', generation), queue.get())
+        self.assertEquals(('c', generation), queue.get())
+        self.assertEquals((None, None), queue.get(timeout=0.01))
+
+    def test_is_wanted(self):
+        queue = DecodeQueue()
+        old = queue.submit(['a', 'b'])
+        self.assertTrue(queue.is_wanted('b', old))
+        queue.submit(['b', 'c'])
+        self.assertTrue(queue.is_wanted('b', old))     # still in the window
+        self.assertFalse(queue.is_wanted('a', old))    # moved far away
+
+    def test_running(self):
+        queue = DecodeQueue()
+        self.assertTrue(queue.start('a'))
+        self.assertFalse(queue.start('a'))
+        self.assertTrue(queue.is_running('a'))
+        done = []
+        waiter = threading.Thread(target=lambda: done.append(queue.wait_for('a')))
+        waiter.start()
+        queue.finish('a')
+        waiter.join(1)
+        self.assertEquals(1, len(done))
+        self.assertFalse(queue.is_running('a'))
+        queue.wait_for('a')     # returns at once when nothing runs
@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from ojo import instance
+
+
+class TestInstance(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'ojo.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_no_server(self):
+        self.assertFalse(instance.hand_over([self.folder], self.path))
+
+    def test_hand_over(self):
+        opened = []
+        received = threading.Event()
+        server = instance.Server(lambda path: (opened.append(path), received.set()), self.path)
+        self.assertTrue(server.start())
+        try:
+            self.assertFalse(instance.Server(lambda path: None, self.path).start())   # already running
+            self.assertTrue(instance.hand_over([self.folder], self.path))
+            received.wait(1)
+            self.assertEquals([os.path.realpath(self.folder)], opened)
+            self.assertTrue(instance.hand_over([], self.path))
+            self.assertFalse(instance.hand_over(['-v', self.folder], self.path))
+            self.assertFalse(instance.hand_over([os.path.join(self.folder, 'missing')], self.path))
+        finally:
+            server.close()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(instance.hand_over([self.folder], self.path))
+
+    def test_stale_socket(self):
+        import socket
+        crashed = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        crashed.bind(self.path)     # left behind, nobody listening
+        crashed.close()
+        server = instance.Server(lambda path: None, self.path)
+        self.assertTrue(server.start())
+        server.close()
+
+    def test_foreign_file_left_alone(self):
+        open(self.path, 'w').close()
+        self.assertFalse(instance.hand_over([self.folder], self.path))
+        self.assertRaises(IOError, instance.Server(lambda path: None, self.path).start)
+        self.assertTrue(os.path.isfile(self.path))
+
+    def test_private_dir(self):
+        self.assertTrue(instance.is_private_dir(self.folder))
+        os.chmod(self.folder, 0755)
+        self.assertFalse(instance.is_private_dir(self.folder))
@@ -0,0 +1,35 @@
+import os
+import shutil
+import tempfile
+import unittest
+from ojo.metaindex import MetaIndex
+
+
+class TestMetaIndex(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.dir, 'meta.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_persists_and_validates(self):
+        index = MetaIndex(self.db_path)
+        index.put('/pics/a.jpg', 100, 1.5, (True, True, 4000, 3000, 6))
+        self.assertEquals((True, True, 4000, 3000, 6), index.get('/pics/a.jpg', 100, 1.5))
+        index.close()
+
+        index = MetaIndex(self.db_path)
+        self.assertEquals((True, True, 4000, 3000, 6), index.get('/pics/a.jpg', 100, 1.5))
+        self.assertEquals(None, index.get('/pics/a.jpg', 100, 2.5))
+        self.assertEquals(None, index.get('/pics/b.jpg', 100, 1.5))
+
+    def test_load_folder(self):
+        index = MetaIndex(self.db_path, batch_size=2)
+        index.put('/pics/a.jpg', 1, 1.0, (False, False, 10, 20, None))
+        index.put('/pics/b.jpg', 2, 2.0, (False, False, 30, 40, 1))
+        index.put('/pics/c.jpg', 3, 3.0, (False, False, 50, 60, 1))
+        index.put('/other/d.jpg', 4, 4.0, (False, False, 70, 80, 1))
+        folder = index.load_folder('/pics')
+        self.assertEquals(['/pics/a.jpg', '/pics/b.jpg', '/pics/c.jpg'], sorted(folder.keys()))
+        self.assertEquals((3, 3.0, (False, False, 50, 60, 1)), folder['/pics/c.jpg'])
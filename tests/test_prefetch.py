@@ -0,0 +1,19 @@
+import unittest
+from ojo.prefetch import NavigationTracker
+
+
+class TestNavigationTracker(unittest.TestCase):
+    def test_idle_window(self):
+        tracker = NavigationTracker()
+        self.assertEquals([1, -1], tracker.get_offsets(now=100))
+        tracker.register(-1, now=100)
+        self.assertEquals([-1, 1], tracker.get_offsets(now=110))
+
+    def test_window_grows_with_speed(self):
+        tracker = NavigationTracker(ahead=4, behind=1, max_ahead=6)
+        tracker.register(-1, now=100)
+        self.assertEquals([-1, 1, -2, -3, -4], tracker.get_offsets(now=100.1))
+        for i in range(20):
+            tracker.register(1, now=101 + i * 0.1)
+        self.assertEquals((6, 1), tracker.get_window(now=103))
+        self.assertEquals((1, 1), tracker.get_window(now=110))
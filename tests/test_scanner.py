@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import unittest
+from ojo import scanner
+
+
+class TestScanner(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.dir, 'sub'))
+        with open(os.path.join(self.dir, 'a.jpg'), 'w') as f:
+            f.write('12345')
+        os.symlink(os.path.join(self.dir, 'missing'), os.path.join(self.dir, 'broken.jpg'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_scan_folder(self):
+        model = scanner.scan_folder(self.dir)
+        self.assertEquals([os.path.join(self.dir, 'a.jpg')], model.files())
+        self.assertEquals([os.path.join(self.dir, 'sub')], model.folders())
+        self.assertEquals(5, model.get(os.path.join(self.dir, 'a.jpg')).size)
+        self.assertEquals(None, model.get('/elsewhere/a.jpg'))
+        self.assertEquals([os.path.join(self.dir, 'sub')], scanner.list_subfolders(self.dir))
+
+    def test_update(self):
+        model = scanner.scan_folder(self.dir)
+        path = os.path.join(self.dir, 'b.png')
+        with open(path, 'w') as f:
+            f.write('1')
+        self.assertEquals(1, model.update(path).size)
+        os.unlink(path)
+        self.assertEquals(None, model.update(path))
+        self.assertEquals(None, model.get(path))
+
+    def test_apply_changes(self):
+        model = scanner.scan_folder(self.dir)
+        a = os.path.join(self.dir, 'a.jpg')
+        b = os.path.join(self.dir, 'b.png')
+        is_image = lambda entry: entry.is_file and entry.name.endswith(('.jpg', '.png'))
+
+        with open(b, 'w') as f:
+            f.write('1')
+        with open(a, 'w') as f:
+            f.write('changed')
+        self.assertEquals(([b], [], [a], False), model.apply_changes({a, b}, [a], is_image))
+
+        os.unlink(a)
+        new_folder = os.path.join(self.dir, 'new')
+        os.mkdir(new_folder)
+        self.assertEquals(([], [a], [], True), model.apply_changes({a, new_folder}, [a, b], is_image))
+
+        os.unlink(b)    # the last image
+        self.assertEquals(([], [b], [], False), model.apply_changes({b}, [b], is_image))
+        self.assertEquals(None, model.get(b))
+
+    def test_walk_files(self):
+        for name in ('sub/b.jpg', 'sub/.c.jpg', '.hidden/d.jpg'):
+            path = os.path.join(self.dir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.mkdir(os.path.dirname(path))
+            open(path, 'w').close()
+        in_dir = lambda *names: [os.path.join(self.dir, n) for n in names]
+        self.assertEquals(in_dir('a.jpg', 'broken.jpg'), scanner.walk_files(self.dir))
+        self.assertEquals(in_dir('a.jpg', 'broken.jpg', '.hidden/d.jpg', 'sub/.c.jpg', 'sub/b.jpg'),
+                          scanner.walk_files(self.dir, recursive=True))
+        self.assertEquals(in_dir('a.jpg', 'broken.jpg', 'sub/b.jpg'),
+                          scanner.walk_files(self.dir, True, lambda name: name.startswith('.')))
@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+import unittest
+from ojo.thumbcache import ThumbnailCache
+
+
+class TestThumbnailCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.dir, 'cache')
+        os.makedirs(self.root)
+        self.source = os.path.join(self.dir, 'a.jpg')
+        self.write(self.source, 10)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, path, size):
+        with open(path, 'wb') as f:
+            f.write('x' * size)
+        return path
+
+    def add(self, cache, source, size, last_used):
+        mtime = os.path.getmtime(source)
+        thumb = self.write(cache.path_for(source, mtime), size)
+        cache.record_use(thumb, source, mtime, now=last_used)
+        return thumb
+
+    def test_sharded_paths(self):
+        cache = ThumbnailCache(self.root, 1000, 1000)
+        thumb = cache.path_for('/pics/a.jpg', 1.5)
+        folder, name = os.path.split(thumb)
+        self.assertEquals(self.root, os.path.dirname(folder))
+        self.assertEquals(name[:2], os.path.basename(folder))
+        self.assertTrue(os.path.isdir(folder))
+        self.assertTrue(cache.owns(thumb))
+        self.assertFalse(cache.owns('/pics/a.jpg'))
+        self.assertNotEquals(thumb, cache.path_for('/pics/a.jpg', 2.5))
+
+    def test_prune_orphans_and_legacy(self):
+        cache = ThumbnailCache(self.root, 1000, 1000)
+        thumb = self.add(cache, self.source, 10, 100)
+        gone = self.add(cache, self.write(os.path.join(self.dir, 'b.jpg'), 10), 10, 100)
+        os.unlink(os.path.join(self.dir, 'b.jpg'))
+        self.write(os.path.join(self.root, '_tmp_a_jpg_' + 'f' * 32 + '.jpg'), 10)
+        other = self.write(os.path.join(self.root, 'notes.txt'), 10)    # not a thumbnail, not ours to delete
+        writing = self.write(os.path.join(os.path.dirname(thumb), 'tmpabc.tmp'), 10)   # not a thumbnail yet
+
+        self.assertEquals((2, 20), cache.prune(now=200))
+        self.assertTrue(os.path.exists(writing))
+        self.assertTrue(os.path.exists(other))
+        self.assertTrue(os.path.exists(thumb))
+        self.assertFalse(os.path.exists(gone))
+        stats = cache.stats()
+        self.assertEquals((1, 10, 1, 0), (stats['count'], stats['bytes'], stats['indexed'], stats['legacy_count']))
+        self.assertFalse(cache.needs_gc(1000, now=300))
+
+    def test_prune_by_age_and_size(self):
+        cache = ThumbnailCache(self.root, 25, 1000)
+        sources = [self.write(os.path.join(self.dir, '%d.jpg' % i), 1) for i in range(4)]
+        thumbs = [self.add(cache, s, 10, 100 * (i + 1)) for i, s in enumerate(sources)]
+        # the first one is too old, then the second one is the least recently used
+        self.assertEquals((2, 20), cache.prune(now=1150))
+        self.assertEquals([False, False, True, True], [os.path.exists(t) for t in thumbs])
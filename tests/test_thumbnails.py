@@ -0,0 +1,45 @@
+import unittest
+from ojo import thumbnails
+
+
+class Preview(object):
+    def __init__(self, w, h):
+        self.dimensions = (w, h)
+
+
+class Meta(object):
+    def __init__(self, dimensions, previews):
+        self.dimensions = dimensions
+        self.previews = previews
+
+
+class TestSelectPreview(unittest.TestCase):
+    def test_smallest_covering(self):
+        meta = Meta((6000, 4000), [Preview(1620, 1080), Preview(240, 160), Preview(6000, 4000)])
+        self.assertEquals((240, 160), thumbnails.select_preview(meta, 360, 120).dimensions)
+        self.assertEquals((1620, 1080), thumbnails.select_preview(meta, 1600, 400).dimensions)
+
+    def test_orientation_and_letterboxing(self):
+        meta = Meta((6000, 4000), [Preview(160, 120), Preview(150, 100), Preview(1620, 1080)])
+        self.assertEquals((1620, 1080), thumbnails.select_preview(meta, 360, 120).dimensions)
+        self.assertEquals((150, 100), thumbnails.select_preview(meta, 360, 120, orientation=6).dimensions)
+
+    def test_fallback_to_largest(self):
+        meta = Meta((6000, 4000), [Preview(150, 100)])
+        self.assertEquals(None, thumbnails.select_preview(meta, 360, 120))
+        self.assertEquals((150, 100), thumbnails.select_preview(meta, 360, 120, fallback_to_largest=True).dimensions)
+
+
+class TestIsRaw(unittest.TestCase):
+    def test_is_raw(self):
+        self.assertTrue(thumbnails.is_raw('/pics/DSC_0001.NEF'))
+        self.assertTrue(thumbnails.is_raw('/pics/IMG_0001.cr2'))
+        self.assertFalse(thumbnails.is_raw('/pics/IMG_0001.jpg'))
+        self.assertFalse(thumbnails.is_raw('/pics/raw'))
+
+
+class TestFindMissing(unittest.TestCase):
+    def test_find_missing(self):
+        images = ['/pics/a.jpg', '/pics/b.jpg', '/pics/c.jpg', '/pics/d.jpg']
+        self.assertEquals(['/pics/a.jpg', '/pics/d.jpg'], thumbnails.find_missing(
+            images, lambda img: img == '/pics/b.jpg', lambda img: img == '/pics/c.jpg'))
@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from ojo.thumbpack import Packed, ThumbPack, PackStore
+
+
+class TestThumbPack(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.dir, 'packs')
+        self.folder = os.path.join(self.dir, 'pics')
+        os.makedirs(self.folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def image(self, name, data='x'):
+        path = os.path.join(self.folder, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        st = os.stat(path)
+        return path, st.st_mtime, st.st_size
+
+    def test_put_get_reload(self):
+        pack = ThumbPack(self.root, self.folder)
+        self.assertEquals(None, pack.get('a.jpg', 1.5, 10))
+        pack.put('a.jpg', 1.5, 10, '\xff\xd8first')
+        pack.put('b.jpg', 2.5, 20, 'second')
+        pack.put('a.jpg', 3.5, 10, '\xff\xd8replaced')
+        self.assertEquals('\xff\xd8replaced', pack.get('a.jpg', 3.5, 10))
+        self.assertEquals(None, pack.get('a.jpg', 1.5, 10))   # outdated
+
+        pack = ThumbPack(self.root, self.folder)
+        self.assertEquals('\xff\xd8replaced', pack.get('a.jpg', 3.5, 10))
+        self.assertEquals('second', pack.get('b.jpg', 2.5, 20))
+        self.assertEquals(len('\xff\xd8first'), pack.dead_bytes)
+        pack.remove('b.jpg')
+        self.assertEquals(None, ThumbPack(self.root, self.folder).get('b.jpg', 2.5, 20))
+
+    def test_compact(self):
+        pack = ThumbPack(self.root, self.folder)
+        pack.put('a.jpg', 1, 1, 'a' * 100)
+        pack.put('a.jpg', 2, 1, 'b' * 10)
+        pack.put('c.jpg', 1, 1, 'c' * 10)
+        old_pack = pack.get_pack_path()
+        self.assertEquals(110, pack.compact(lambda name, mtime, size: name != 'c.jpg'))
+        self.assertFalse(os.path.exists(old_pack))
+        self.assertEquals('b' * 10, pack.get('a.jpg', 2, 1))
+        self.assertEquals(None, pack.get('c.jpg', 1, 1))
+        self.assertEquals('b' * 10, ThumbPack(self.root, self.folder).get('a.jpg', 2, 1))
+
+    def test_other_process_compacted(self):
+        pack = ThumbPack(self.root, self.folder)
+        pack.put('a.jpg', 1, 1, 'a' * 10)
+        other = ThumbPack(self.root, self.folder)
+        other.put('b.jpg', 1, 1, 'b' * 10)
+        other.compact()
+        pack.put('c.jpg', 1, 1, 'c' * 10)     # notices the new index and pack
+        fresh = ThumbPack(self.root, self.folder)
+        self.assertEquals(['a.jpg', 'b.jpg', 'c.jpg'], sorted(fresh.entries))
+        self.assertEquals('b' * 10, pack.get('b.jpg', 1, 1))
+
+    def test_store_prune(self):
+        store = PackStore(self.root, 1000, 1000)
+        path, mtime, size = self.image('a.jpg')
+        store.put(path, mtime, size, 'thumb')
+        self.assertEquals('thumb', store.get(path, mtime, size))
+        gone, gone_mtime, gone_size = self.image('b.jpg')
+        store.put(gone, gone_mtime, gone_size, 'x' * 100)
+        os.unlink(gone)
+        self.assertEquals(2, store.stats()['count'])
+        self.assertEquals((1, 100), store.prune())
+        self.assertEquals('thumb', store.get(path, mtime, size))
+        self.assertFalse(store.needs_gc(1000))
+
+        shutil.rmtree(self.folder)
+        self.assertEquals((1, 5), store.prune())
+        self.assertEquals(0, store.stats()['count'])
+
+    def test_store_prune_by_age(self):
+        store = PackStore(self.root, 1000, 86400)
+        path, mtime, size = self.image('a.jpg')
+        store.put(path, mtime, size, 'thumb')
+        index_path = store.get_pack(self.folder).index_path
+        old = int(time.time()) - 10 * 86400
+        os.utime(index_path, (old, old))
+
+        other = PackStore(self.root, 1000, 86400)     # e.g. --cache-stats, then --cache-prune
+        self.assertEquals(1, other.stats()['count'])
+        self.assertEquals(old, os.path.getmtime(index_path))
+        self.assertEquals((1, 5), other.prune())
+        self.assertFalse(os.path.exists(index_path))
+
+    def test_data_uri(self):
+        self.assertEquals('data:image/png;base64,iVBORw==', Packed('\x89PNG').to_data_uri())
+        self.assertTrue(Packed('\xff\xd8').to_data_uri().startswith('data:image/jpeg;'))
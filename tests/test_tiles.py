@@ -0,0 +1,57 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from ojo import tiles
+
+
+class TestTiles(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_level_sizes(self):
+        self.assertEquals([(2000, 1000), (1000, 500), (500, 250)], tiles.level_sizes((2000, 1000), 512))
+        self.assertEquals([(300, 200)], tiles.level_sizes((300, 200), 512))
+        self.assertEquals(0, tiles.level_for_scale(2.5, 3))
+        self.assertEquals(1, tiles.level_for_scale(0.3, 3))
+
+    def test_geometry(self):
+        pyramid = tiles.TilePyramid(self.dir, (2000, 1000), 512)
+        self.assertEquals(0, pyramid.level_for_scale(1))
+        self.assertEquals(0, pyramid.level_for_scale(0.6))
+        self.assertEquals(1, pyramid.level_for_scale(0.5))
+        self.assertEquals(2, pyramid.level_for_scale(0.01))
+        self.assertEquals((1536, 512, 464, 488), pyramid.tile_box(0, 3, 1))
+        self.assertEquals([(1, 0), (2, 0), (1, 1), (2, 1)], pyramid.tiles_in(0, 600, 100, 1100, 600))
+        self.assertEquals([(3, 1)], pyramid.tiles_in(0, 1900, 900, 2500, 1500))
+        self.assertEquals(os.path.join(self.dir, '1', '0_1.ppm'), pyramid.tile_path(1, 0, 1))
+
+    def test_info_and_prune(self):
+        spill_dir = os.path.join(self.dir, 'a')
+        other = os.path.join(self.dir, 'b')
+        os.makedirs(spill_dir)
+        os.makedirs(other)
+        pyramid = tiles.TilePyramid(spill_dir, (4000, 3000), 512)
+        self.assertFalse(pyramid.load_info())
+        with open(os.path.join(spill_dir, tiles.INFO_NAME), 'w') as f:
+            json.dump({'size': [1600, 1200]}, f)
+        self.assertTrue(pyramid.load_info())
+        self.assertEquals((1600, 1200), pyramid.size)
+        self.assertEquals(3, len(pyramid.levels))
+        self.assertFalse(pyramid.is_complete())
+
+        tiles.prune_spill(self.dir, [spill_dir])
+        self.assertEquals(['a'], os.listdir(self.dir))
+
+    def test_failed_build(self):
+        spill_dir = os.path.join(self.dir, 'a')
+        pyramid = tiles.TilePyramid(spill_dir, (4000, 3000), 512)
+        self.assertFalse(pyramid.has_failed())
+        result_dir, error = tiles.build_pyramid_job(os.path.join(self.dir, 'missing.jpg'), 1, spill_dir)
+        self.assertTrue(error)
+        self.assertTrue(pyramid.has_failed())
+        self.assertFalse(pyramid.is_complete())
@@ -1,3 +1,6 @@
+import os
+import shutil
+import tempfile
 import unittest
 from ojo import util
 
@@ -6,4 +9,21 @@ class TestUtil(unittest.TestCase):
         path = '/a/b/c d'
         url = util.path2url(path)
         self.assertEquals('file:///a/b/c%20d', url)
-        self.assertEquals(path, util.url2path(url))
\ No newline at end of file
+        self.assertEquals(path, util.url2path(url))
+
+    def test_to_unicode(self):
+        self.assertEquals([u'\xe4', [u'\xe4', 1], {u'k': u'\xe4'}, None],
+                          util.to_unicode(['\xc3\xa4', ('\xe4', 1), {'k': '\xe4'}, None]))
+
+    def test_write_atomically(self):
+        folder = tempfile.mkdtemp()
+        try:
+            target = os.path.join(folder, 'sub', 'a.jpg')
+            util.write_atomically(target, lambda f: f.write('data'))
+            self.assertEquals(['a.jpg'], os.listdir(os.path.dirname(target)))
+            self.assertEquals(0600, os.stat(target).st_mode & 0777)
+            self.assertRaises(ValueError, util.write_atomically, target, lambda f: int('x'))
+            self.assertEquals(['a.jpg'], os.listdir(os.path.dirname(target)))
+            self.assertEquals('data', open(target).read())
+        finally:
+            shutil.rmtree(folder)
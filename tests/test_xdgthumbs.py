@@ -0,0 +1,74 @@
+import hashlib
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+from ojo import xdgthumbs
+
+
+def png_chunk(chunk_type, data):
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff)
+
+
+def write_png(path, size, text):
+    folder = os.path.dirname(path)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    with open(path, 'wb') as f:
+        f.write(xdgthumbs.PNG_SIGNATURE)
+        f.write(png_chunk('IHDR', struct.pack('>IIBBBBB', size[0], size[1], 8, 2, 0, 0, 0)))
+        for key, value in text.items():
+            f.write(png_chunk('tEXt', key + '\0' + value))
+        f.write(png_chunk('IEND', ''))
+
+
+class TestXdgThumbs(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.old_cache_home = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = self.dir
+
+    def tearDown(self):
+        if self.old_cache_home is None:
+            del os.environ['XDG_CACHE_HOME']
+        else:
+            os.environ['XDG_CACHE_HOME'] = self.old_cache_home
+        shutil.rmtree(self.dir)
+
+    def test_paths(self):
+        self.assertEquals('file:///pics/my%20photo%231.jpg', xdgthumbs.file_uri('/pics/my photo#1.jpg'))
+        self.assertEquals(
+            os.path.join(self.dir, 'thumbnails', 'large', hashlib.md5('file:///pics/a.jpg').hexdigest() + '.png'),
+            xdgthumbs.thumbnail_path('/pics/a.jpg', 'large'))
+
+    def test_read_png_info(self):
+        path = os.path.join(self.dir, 'x.png')
+        write_png(path, (256, 170), {'Thumb::URI': 'file:///pics/a.jpg', 'Thumb::MTime': '123'})
+        self.assertEquals(((256, 170), {'Thumb::URI': 'file:///pics/a.jpg', 'Thumb::MTime': '123'}),
+                          xdgthumbs.read_png_info(path))
+
+    def test_lookup(self):
+        text = {'Thumb::URI': 'file:///pics/a.jpg', 'Thumb::MTime': '123'}
+        self.assertEquals(None, xdgthumbs.lookup('/pics/a.jpg', 123, 120))
+
+        write_png(xdgthumbs.thumbnail_path('/pics/a.jpg', 'normal'), (128, 85), text)
+        self.assertEquals(None, xdgthumbs.lookup('/pics/a.jpg', 123, 120))   # too small
+
+        write_png(xdgthumbs.thumbnail_path('/pics/a.jpg', 'large'), (256, 170), text)
+        self.assertEquals(xdgthumbs.thumbnail_path('/pics/a.jpg', 'large'), xdgthumbs.lookup('/pics/a.jpg', 123, 120))
+        self.assertEquals(None, xdgthumbs.lookup('/pics/a.jpg', 124, 120))   # stale
+
+        # small originals are not upscaled, the normal thumbnail is then as good as it gets
+        text.update({'Thumb::Image::Width': '120', 'Thumb::Image::Height': '80'})
+        write_png(xdgthumbs.thumbnail_path('/pics/a.jpg', 'normal'), (120, 80), text)
+        self.assertEquals(xdgthumbs.thumbnail_path('/pics/a.jpg', 'normal'), xdgthumbs.lookup('/pics/a.jpg', 123, 120))
+
+    def test_is_failed(self):
+        text = {'Thumb::URI': 'file:///pics/a.jpg', 'Thumb::MTime': '123'}
+        self.assertFalse(xdgthumbs.is_failed('/pics/a.jpg', 123))
+        write_png(xdgthumbs.fail_path('/pics/a.jpg', 'other-app'), (1, 1), text)
+        self.assertTrue(xdgthumbs.is_failed('/pics/a.jpg', 123))
+        self.assertFalse(xdgthumbs.is_failed('/pics/a.jpg', 123, 'ojo'))
+        self.assertFalse(xdgthumbs.is_failed('/pics/a.jpg', 124))